@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+"""bulk.py
+
+Bulk import of conferences, speakers and sessions.
+
+Rows are read as a stream, either NDJSON (one JSON object per line) or CSV
+with a header row. Each row has a `kind` ('conference', 'speaker' or
+'session'), the fields of its form (ConferenceForm, SpeakerForm or
+SessionEditForm; in CSV, values of repeated fields are separated by ';'),
+and optionally a `ref`, a name for the new entity that later rows may use
+in place of its websafe key:
+
+    {"kind": "speaker", "ref": "ada", "name": "Ada Lovelace"}
+    {"kind": "conference", "ref": "pycon", "name": "PyCon",
+     "organizerUserId": "organizer@example.com", "startDate": "2016-05-28"}
+    {"kind": "session", "websafeConferenceKey": "pycon",
+     "websafeSpeakerKey": "ada", "name": "Engines", "duration": 45}
+
+Rows are validated with the same rules as createConference, createSpeaker
+and createSession; invalid rows are rejected and reported, and the import
+goes on. Valid rows are written in batches: ids are allocated in ranges,
+entities are written with put_multi, speaker session counts are updated
+once per conference, and the tasks the endpoints would enqueue per entity
+are enqueued once per batch, organizer or conference.
+
+An ImportJob checkpoints the import after every batch, so an import that
+failed or ran out of time resumes when the same rows are sent again with
+the same job id. The keys of a batch are stored before it is written, so
+a batch that was written partly is rewritten under the same keys.
+
+"""
+
+import csv
+import json
+import logging
+import re
+import time
+from collections import defaultdict
+
+import endpoints
+from protorpc import messages
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+from cache import bump_generations
+from conference import ConferenceApi
+from conference import SESSIONS_GENERATION_TPL
+from conference import SPEAKERS_GENERATION
+from models import Conference
+from models import ConferenceForm
+from models import ImportJob
+from models import Profile
+from models import Session
+from models import SessionEditForm
+from models import Speaker
+from models import SpeakerForm
+import seats
+
+BATCH_SIZE = 100            # rows per put_multi
+IMPORT_SECONDS = 45         # an import request stops after this long
+MAX_ERRORS = 100            # errors kept in the ImportJob
+LIST_SEPARATOR = ';'        # between values of repeated fields in CSV
+TASK_BATCH_SIZE = 100       # tasks per taskqueue add
+JOB_ID = re.compile(r'^[a-zA-Z0-9_-]{1,100}$')
+
+FORMS = {
+    'conference': ConferenceForm,
+    'speaker': SpeakerForm,
+    'session': SessionEditForm,
+}
+
+# errors that reject a row
+_ROW_ERRORS = (ValueError, TypeError, messages.ValidationError,
+               endpoints.BadRequestException)
+
+
+def ndjson_rows(stream):
+    """Yield the rows of an NDJSON stream, as unparsed lines."""
+    for line in iter(stream.readline, ''):
+        line = line.strip()
+        if line:
+            yield line
+
+
+def csv_rows(stream):
+    """Yield the rows of a CSV stream with a header row, as dicts."""
+    for row in csv.DictReader(iter(stream.readline, '')):
+        yield dict((name, value.decode('utf-8'))
+                   for name, value in row.items()
+                   if name and value is not None)
+
+
+def _convert(field, value):
+    """Convert a JSON or CSV value to the type of a message field."""
+    if isinstance(field, messages.IntegerField):
+        return int(value)
+    if isinstance(field, messages.BooleanField):
+        if isinstance(value, basestring):
+            return value.lower() in ('1', 'true', 'yes')
+        return bool(value)
+    if isinstance(field, messages.EnumField):
+        return field.type(str(value))
+    if isinstance(field, messages.StringField):
+        return unicode(value)
+    return value
+
+
+def _parse(row):
+    """Return (kind, ref, form message, row) of a row. Raises ValueError,
+    TypeError or ValidationError if the row is malformed.
+    """
+    if isinstance(row, basestring):
+        row = json.loads(row)
+    if not isinstance(row, dict):
+        raise ValueError('Row is not an object.')
+    kind = row.get('kind')
+    if kind not in FORMS:
+        raise ValueError("'kind' must be one of: %s"
+                         % ', '.join(sorted(FORMS)))
+
+    message = FORMS[kind]()
+    for field in message.all_fields():
+        value = row.get(field.name)
+        if value is None or value == '':
+            continue
+        if field.repeated:
+            if isinstance(value, basestring):
+                value = [item.strip() for item in value.split(LIST_SEPARATOR)
+                            if item.strip()]
+            setattr(message, field.name,
+                    [_convert(field, item) for item in value])
+        else:
+            setattr(message, field.name, _convert(field, value))
+    message.check_initialized()
+    return kind, row.get('ref') or None, message, row
+
+
+def _key(job, value, model_class):
+    """Return the key of value, a ref of the import or a websafe key of an
+    entity of model_class. Raises ValueError if it is neither.
+    """
+    if not value:
+        raise ValueError('%s key required' % model_class._get_kind().lower())
+    try:
+        key = ndb.Key(urlsafe=job.refs.get(value, value))
+    except (TypeError, ProtocolBufferDecodeError):
+        key = None
+    if key is None or key.kind() != model_class._get_kind():
+        raise ValueError('Unknown %s: %s'
+                         % (model_class._get_kind().lower(), value))
+    return key
+
+
+def _allocate(keys, wanted):
+    """Allocate ids, one range per (model class, parent) of wanted, a dict
+    {(model class, parent): [row numbers]}, and set keys[row number]."""
+    for (model_class, parent), numbers in wanted.items():
+        first, last = model_class.allocate_ids(size=len(numbers),
+                                               parent=parent)
+        for number, id_ in zip(numbers, range(first, last + 1)):
+            keys[number] = ndb.Key(model_class, id_, parent=parent)
+
+
+def _add_tasks(job, first_row, tasks):
+    """Enqueue tasks, (url, params) pairs, named after the job and batch so
+    that a resumed batch does not enqueue them twice."""
+    tasks = [taskqueue.Task(url=url, params=params,
+                            name='import-%s-%d-%d' % (job.key.id(),
+                                                      first_row, i))
+             for i, (url, params) in enumerate(tasks)]
+    queue = taskqueue.Queue()
+    for i in range(0, len(tasks), TASK_BATCH_SIZE):
+        try:
+            queue.add(tasks[i:i + TASK_BATCH_SIZE])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # added before the batch was resumed; the others are added
+            pass
+
+
+def _import_batch(job, batch):
+    """Validate and write a batch of (row number, row) and checkpoint the
+    job."""
+    started = time.time()
+    pending = job.pending or {}
+    # a copy, so the batch never changes a value shared with other entities
+    job.refs = dict(job.refs or {})
+    keys = dict((number, ndb.Key(urlsafe=wsk))
+                for number, wsk in pending.items())
+    errors = []
+    rows = []       # valid rows: (number, kind, ref, message, row, data)
+
+    def reject(number, e):
+        errors.append('row %d: %s' % (number, e))
+
+    # conferences and speakers
+    parsed = []
+    for number, row in batch:
+        try:
+            parsed.append((number,) + _parse(row))
+        except _ROW_ERRORS as e:
+            reject(number, e)
+
+    p_keys = set(ndb.Key(Profile, message.organizerUserId)
+                 for number, kind, ref, message, row in parsed
+                 if kind == 'conference' and message.organizerUserId)
+    profiles = dict((prof.key, prof)
+                    for prof in ndb.get_multi(list(p_keys)) if prof)
+
+    refs = set()
+    wanted = defaultdict(list)
+    for number, kind, ref, message, row in parsed:
+        try:
+            # a resumed batch has set its refs already
+            if ref is not None and (ref in refs or ref in job.refs and
+                                    job.refs[ref] != pending.get(number)):
+                raise ValueError('Duplicate ref: %s' % ref)
+            if kind == 'conference':
+                if not message.organizerUserId:
+                    raise ValueError("'organizerUserId' field required")
+                data = ConferenceApi._conferenceData(message)
+                p_key = ndb.Key(Profile, message.organizerUserId)
+                prof = profiles.get(p_key)
+                data['organizerUserId'] = message.organizerUserId
+                data['organizerDisplayName'] = \
+                    message.organizerDisplayName = \
+                        prof.displayName if prof else ''
+                if number not in keys:
+                    wanted[(Conference, p_key)].append(number)
+            elif kind == 'speaker':
+                data = ConferenceApi._speakerData(message)
+                if number not in keys:
+                    wanted[(Speaker, None)].append(number)
+            else:
+                data = None
+        except _ROW_ERRORS as e:
+            reject(number, e)
+            continue
+        if ref is not None:
+            refs.add(ref)
+        rows.append((number, kind, ref, message, row, data))
+    _allocate(keys, wanted)
+    for number, kind, ref, message, row, data in rows:
+        if ref is not None and kind != 'session':
+            job.refs[ref] = keys[number].urlsafe()
+
+    # sessions, which may refer to conferences and speakers of the batch
+    entities = dict((keys[number], data)
+                    for number, kind, ref, message, row, data in rows
+                    if data is not None)
+    referred = set()
+    for number, kind, ref, message, row, data in rows:
+        if kind == 'session':
+            for value, model_class in (
+                    (row.get('websafeConferenceKey'), Conference),
+                    (message.websafeSpeakerKey, Speaker)):
+                try:
+                    referred.add(_key(job, value, model_class))
+                except ValueError:
+                    pass
+    referred = list(referred - set(entities))
+    existing = dict((entity.key, entity)
+                    for entity in ndb.get_multi(referred) if entity)
+
+    wanted = defaultdict(list)
+    valid = []
+    for number, kind, ref, message, row, data in rows:
+        if kind != 'session':
+            valid.append((number, kind, ref, message, row, data))
+            continue
+        try:
+            c_key = _key(job, row.get('websafeConferenceKey'), Conference)
+            s_key = _key(job, message.websafeSpeakerKey, Speaker)
+            if c_key in entities:
+                conf = Conference(**entities[c_key])
+            elif c_key in existing:
+                conf = existing[c_key]
+            else:
+                raise ValueError('No conference found for key: %s'
+                                 % c_key.urlsafe())
+            if s_key not in entities and s_key not in existing:
+                raise ValueError('No speaker found for key: %s'
+                                 % s_key.urlsafe())
+            message.websafeSpeakerKey = s_key.urlsafe()
+            data = ConferenceApi._sessionData(message, conf)
+        except _ROW_ERRORS as e:
+            reject(number, e)
+            continue
+        if number not in keys:
+            wanted[(Session, c_key)].append(number)
+        valid.append((number, kind, ref, message, row, data))
+    rows = valid
+    _allocate(keys, wanted)
+
+    # store the keys of the batch, then write it
+    if job.pending is None:
+        job.pending = dict((number, keys[number].urlsafe())
+                           for number, kind, ref, message, row, data in rows)
+        job.put()
+
+    model_classes = {'conference': Conference, 'speaker': Speaker,
+                     'session': Session}
+    to_put = []
+    for number, kind, ref, message, row, data in rows:
+        to_put.append(model_classes[kind](key=keys[number], **data))
+        if kind == 'conference':
+            to_put.extend(seats.new_shards(keys[number],
+                                           data['seatsAvailable']))
+    ndb.put_multi(to_put)
+
+    by_conference = defaultdict(list)
+    for entity in to_put:
+        if isinstance(entity, Session):
+            by_conference[entity.key.parent()].append(entity)
+    for sessions in by_conference.values():
+        ndb.transaction(
+            lambda: ConferenceApi._countSpeakerSessions(sessions))
+
+    # invalidate caches and enqueue the tasks of the batch
+    generations = set()
+    confirmations = defaultdict(list)
+    checks = set()
+    for number, kind, ref, message, row, data in rows:
+        if kind == 'conference':
+            confirmations[keys[number].parent()].append(repr(message))
+        elif kind == 'speaker':
+            generations.add(SPEAKERS_GENERATION)
+        else:
+            wsck = keys[number].parent().urlsafe()
+            generations.add(SESSIONS_GENERATION_TPL % wsck)
+            checks.add((data['websafeSpeakerKey'], wsck))
+    schedules = set(wsck for wssk, wsck in checks)
+
+    if confirmations:
+        ConferenceApi._conferencesChanged()
+    if generations:
+        bump_generations(list(generations))
+    ndb.delete_multi([ConferenceApi._scheduleKey(wsck)
+                      for wsck in schedules])
+
+    tasks = []
+    for p_key, infos in confirmations.items():
+        prof = profiles.get(p_key)
+        if prof and prof.mainEmail:
+            tasks.append(('/tasks/send_confirmation_email',
+                          {'email': prof.mainEmail,
+                           'conferenceInfo': '\r\n\r\n'.join(infos)}))
+    for wsck in sorted(schedules):
+        tasks.append(('/tasks/rebuild_schedule',
+                      {'websafeConferenceKey': wsck}))
+    _add_tasks(job, batch[0][0], tasks)
+    for wssk, wsck in sorted(checks):
+        ConferenceApi._checkSpeakerLater(wssk, wsck)
+
+    # checkpoint
+    job.rowsDone = batch[-1][0] + 1
+    job.pending = None
+    job.entities += len(rows)
+    job.rejected += len(errors)
+    job.errors = (job.errors + errors)[:MAX_ERRORS]
+    job.seconds += time.time() - started
+    job.put()
+
+
+def run(job_id, rows, seconds=IMPORT_SECONDS):
+    """Import rows, from ndjson_rows() or csv_rows(), as ImportJob job_id,
+    resuming the job if it exists. Stops after the first batch that ends
+    more than `seconds` after the start; the job is done when all rows are
+    imported. Returns the ImportJob. Raises ValueError for invalid job ids.
+    """
+    if not JOB_ID.match(job_id or ''):
+        raise ValueError('Job ids are 1 to 100 letters, digits, - or _.')
+    deadline = time.time() + seconds
+    job = ImportJob.get_or_insert(job_id)
+
+    batch = []
+    for number, row in enumerate(rows):
+        if job.done or time.time() > deadline:
+            break
+        if number < job.rowsDone:
+            continue
+        batch.append((number, row))
+        if len(batch) == BATCH_SIZE:
+            _import_batch(job, batch)
+            batch = []
+    else:
+        if batch:
+            _import_batch(job, batch)
+        job.done = True
+        job.put()
+
+    logging.info('Import %s: %d rows, %d entities in %.1f s (%s/s)',
+                 job_id, job.rowsDone, job.entities, job.seconds,
+                 report(job)['entitiesPerSecond'])
+    return job
+
+
+def report(job):
+    """Return the progress of an ImportJob as a dict."""
+    return {
+        'job': job.key.id(),
+        'done': job.done,
+        'rowsDone': job.rowsDone,
+        'entities': job.entities,
+        'rejected': job.rejected,
+        'errors': job.errors,
+        'seconds': round(job.seconds, 3),
+        'entitiesPerSecond':
+            round(job.entities / job.seconds, 1) if job.seconds else None,
+    }
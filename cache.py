@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Conference Central caching helpers: generation counters, generation-stamped
+memcache values and a per-instance LRU cache.
+
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+GENERATION_KEY_TPL = 'GENERATION:%s'
+
+
+def _initial_generation():
+    """Generations start from the current time in milliseconds, so a counter
+    that was evicted from memcache never goes back to an old value.
+    """
+    return int(time.time() * 1000)
+
+
+def bump_generation(name):
+    """Increment the named generation counter, invalidating every value that
+    was cached under an older generation. Returns the new generation.
+    """
+    return memcache.incr(GENERATION_KEY_TPL % name,
+                         initial_value=_initial_generation())
+
+
+def bump_generations(names):
+    """Increment several generation counters with a single memcache call."""
+    if names:
+        memcache.offset_multi(
+            dict((GENERATION_KEY_TPL % name, 1) for name in names),
+            initial_value=_initial_generation())
+
+
+def get_generations(names):
+    """Return {name: current generation} of the named generation counters,
+    read with a single memcache call; missing counters are started.
+    """
+    keys = dict((GENERATION_KEY_TPL % name, name) for name in names)
+    found = memcache.get_multi(keys.keys())
+    missing = [key for key in keys if key not in found]
+    if missing:
+        initial = _initial_generation()
+        not_added = memcache.add_multi(dict((key, initial) for key in missing))
+        for key in missing:
+            found[key] = initial
+        if not_added:
+            # started by another request meanwhile
+            found.update(memcache.get_multi(not_added))
+    return dict((name, found[key]) for key, name in keys.items())
+
+
+def get_versioned(key, generation_name):
+    """Return (value, generation) for a value cached with set_versioned().
+
+    Both the value and the current generation are read with a single memcache
+    call. value is None if nothing is cached or the cached value belongs to an
+    older generation.
+    """
+    gen_key = GENERATION_KEY_TPL % generation_name
+    found = memcache.get_multi([gen_key, key])
+    generation = found.get(gen_key)
+    if generation is None:
+        generation = _initial_generation()
+        if not memcache.add(gen_key, generation):
+            generation = memcache.get(gen_key) or generation
+        return None, generation
+
+    cached = found.get(key)
+    if cached is None or cached[0] != generation:
+        return None, generation
+    return cached[1], generation
+
+
+def set_versioned(key, value, generation, ttl=0):
+    """Cache value stamped with generation (as returned by get_versioned)."""
+    memcache.set(key, (generation, value), time=ttl)
+
+
+class LRUCache(object):
+    """Per-instance least recently used cache whose entries expire after
+    `ttl` seconds. Safe to share between request threads.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        """Return cached value for key, or None if missing or expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert as the most recently used entry
+            self._entries[key] = entry
+            return value
+
+
+    def put(self, key, value):
+        """Cache value for key, evicting the least recently used entry if the
+        cache is full.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+    def pop(self, key):
+        """Remove key from the cache."""
+        with self._lock:
+            self._entries.pop(key, None)
@@ -13,21 +13,36 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import hashlib
+import time
+import uuid
+from bisect import bisect_left
+from bisect import bisect_right
 from datetime import datetime
+from datetime import timedelta
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.api.datastore_errors import BadArgumentError
+from google.appengine.api.datastore_errors import BadRequestError
+from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+from models import AlmostSoldOut
 from models import ConflictException
+from models import NotModifiedException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
+from models import Registration
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
@@ -35,22 +50,43 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import ConferenceSchedule
+from models import ScheduleChunk
 from models import TeeShirtSize
 from models import Speaker
 from models import SpeakerForm
 from models import SpeakerForms
+from models import SpeakerSessionCount
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionConflictForm
 from models import SessionEditForm
 from models import SessionType
+from models import QueryStatsForm
+from models import QueryStatsForms
+from models import WishlistIndex
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import CONFERENCE_CACHE_STALENESS
 
+from cache import bump_generation
+from cache import bump_generations
+from cache import get_generations
+from cache import get_versioned
+from cache import LRUCache
+from cache import set_versioned
+
+import seats
+import stats
+
+from converters import copier
+import fieldmask
 from utils import getUserId
+from utils import MultiCursor
 from utils import MultiPropInequality
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
@@ -58,9 +94,120 @@ API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_SEATS = 5 # conferences with 1 to this many seats left
+ALMOST_SOLD_OUT_ID = 'announcement'
 MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER"
+MEMCACHE_FEATURED_SPEAKER_TPL = "FEATURED_SPEAKER:%s"
+FEATURED_SPEAKER_TPL = 'Featured Speaker: {} \n Sessions: {}'
+CHECK_SPEAKER_WINDOW = 10 # seconds
+MEMCACHE_QUERY_KEY_TPL = "CONFERENCE_QUERY:%s"
+CONFERENCE_GENERATION = "CONFERENCE"
+QUERY_CACHE_TTL = 600 # seconds
+QUERY_CONSISTENCY_DELAY = 5 # seconds global queries may lag behind writes
+MEMCACHE_CONFERENCE_FORM_TPL = "CONFERENCE_FORM:%s"
+CONFERENCE_GENERATION_TPL = "CONFERENCE:%s"
+CONFERENCE_FORM_CACHE_TTL = 3600 # seconds
+SESSIONS_GENERATION_TPL = "SESSIONS:%s"
+SPEAKERS_GENERATION = "SPEAKERS"
+SCHEDULE_ID = 'schedule'
+SCHEDULE_BUILD_ATTEMPTS = 3
+SCHEDULE_CHUNK_BYTES = 500000 # of schedule entries per entity
+SCHEDULE_REBUILD_WINDOW = 60 # seconds
+WISHLIST_INDEX_ID = 'wishlist'
+SEAT_RECONCILE_DELAY = 10 # seconds
+MAX_PAGE_SIZE = 100
+STATS_KINDS = ['Conference', 'Session']
+DENORMALIZE_BATCH_SIZE = 100
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+# per-instance cache of encoded ConferenceForms, by websafe key
+_conference_forms = LRUCache(max_size=500, ttl=CONFERENCE_CACHE_STALENESS)
+
+# generated entity to form copiers; dates are converted to date strings,
+# enum names to enums
+_copyConference = copier(Conference, ConferenceForm, dict(
+    (field.name, str) for field in ConferenceForm.all_fields()
+        if field.name.endswith('Date')))
+_copyProfile = copier(Profile, ProfileForm,
+    {'teeShirtSize': lambda value: getattr(TeeShirtSize, value)},
+    excluded=('conferenceKeysToAttend',))
+_copySpeaker = copier(Speaker, SpeakerForm)
+_copySession = copier(Session, SessionForm, {
+    'date': str,
+    'startTime': str,
+    'typeOfSession': lambda value: getattr(SessionType, value)
+})
+
+
+def _scheduleOrder(entry):
+    """Sort key of ConferenceSchedule entries: by date, then startTime;
+    sessions without them come last."""
+    return (entry['date'] is None, entry['date'],
+            entry['startTime'] is None, entry['startTime'])
+
+
+def _scheduleChunks(entries):
+    """Split ConferenceSchedule entries into lists of up to about
+    SCHEDULE_CHUNK_BYTES, each stored in one entity; there is always at
+    least one."""
+    chunks = [[]]
+    size = 0
+    for entry in entries:
+        # the encoded form, and about as much again for the other fields
+        entry_size = len(entry['form']) + 200
+        if chunks[-1] and size + entry_size > SCHEDULE_CHUNK_BYTES:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(entry)
+        size += entry_size
+    return chunks
+
+
+def _olderSpeakers(speakers, stored):
+    """Return True if any of speakers, {websafe speaker key: Speaker.updated}
+    read by a schedule build, was read before an update that the stored
+    schedule's speakers include."""
+    return any(stored.get(key) is not None and
+                (updated is None or updated < stored[key])
+               for key, updated in speakers.items())
+
+
+def _agendaOrder(session):
+    """Sort key of Sessions: by date, then startTime; sessions without them
+    come last."""
+    return (session.date is None, session.date,
+            session.startTime is None, session.startTime)
+
+
+def _sessionInterval(session):
+    """Return the (start, end) datetimes of a Session, or None if its date,
+    startTime or duration is not known."""
+    if session.date is None or session.startTime is None or \
+            not session.duration:
+        return None
+    start = datetime.combine(session.date, session.startTime)
+    return start, start + timedelta(minutes=session.duration)
+
+
+def _conflictGroups(intervals):
+    """Sweep intervals, (start, end, websafe session key) tuples sorted by
+    start, and return SessionConflictForms of the groups of (directly or
+    transitively) overlapping intervals.
+    """
+    groups = []
+    group, groupStart, groupEnd = [], None, None
+    for start, end, key in intervals + [(None, None, None)]:
+        if key is not None and group and start < groupEnd:
+            group.append(key)
+            groupEnd = max(groupEnd, end)
+            continue
+        if len(group) > 1:
+            groups.append(SessionConflictForm(websafeSessionKeys=group,
+                                              start=str(groupStart),
+                                              end=str(groupEnd)))
+        group, groupStart, groupEnd = [key], start, end
+    return groups
+
 DEFAULTS = {
     "city": "Default City",
     "maxAttendees": 0,
@@ -77,6 +224,16 @@ OPERATORS = {
             'NE':   '!='
             }
 
+# estimated fraction of conferences matched by a filter, per operator
+DEFAULT_SELECTIVITY = {
+            '=':    0.1,
+            '!=':   0.9,
+            '<':    0.33,
+            '<=':   0.33,
+            '>':    0.33,
+            '>=':   0.33
+            }
+
 FIELDS =    {
             'CITY': 'city',
             'TOPIC': 'topics',
@@ -84,11 +241,30 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees'
             }
 
+# fieldMask selects the fields of the response (see fieldmask.py)
+FIELD_MASK_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fieldMask=messages.StringField(1),
+)
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_GET_FIELDS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    fieldMask=messages.StringField(2),
+)
+
+CONF_ATTENDEES_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2),
+    cursor=messages.StringField(3),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
@@ -104,6 +280,11 @@ SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     websafeSpeakerKey=messages.StringField(1),
 )
 
+FEATURED_SPEAKER_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+)
+
 SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
     SpeakerForm,
     websafeSpeakerKey=messages.StringField(1),
@@ -125,28 +306,51 @@ SESSION_GET_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1)
 )
 
+WISHLIST_ADD_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeSessionKey=messages.StringField(1),
+    checkConflicts=messages.BooleanField(2)
+)
+
+WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fieldMask=messages.StringField(1),
+    agenda=messages.BooleanField(2)
+)
+
+SESSION_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1),
+    cursor=messages.StringField(2),
+    fieldMask=messages.StringField(3)
+)
+
 SESSION_GET_REQUEST_BY_TYPE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
-    typeOfSession=messages.EnumField(SessionType, 2)
+    typeOfSession=messages.EnumField(SessionType, 2),
+    fieldMask=messages.StringField(3)
 )
 
 SESSION_GET_REQUEST_BY_SPEAKER = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSpeakerKey=messages.StringField(1),
+    fieldMask=messages.StringField(2)
 )
 
 SESSION_GET_REQUEST_BY_DURATION = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
-    duration=messages.IntegerField(2)
+    duration=messages.IntegerField(2),
+    fieldMask=messages.StringField(3)
 )
 
 SESSION_GET_REQUEST_BY_DATE = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
     startDate=messages.StringField(2), # DateTimeField()
-    endDate=messages.StringField(3)    # DateTimeField()
+    endDate=messages.StringField(3),   # DateTimeField()
+    fieldMask=messages.StringField(4)
 )
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -158,41 +362,75 @@ SESSION_GET_REQUEST_BY_DATE = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+# - - - Partial responses - - - - - - - - - - - - - - - - -
+
+    def _fieldMask(self, request):
+        """Return the parsed fieldMask of request (see fieldmask.py); None
+        selects all fields.
+        """
+        try:
+            return fieldmask.parse(getattr(request, 'fieldMask', None))
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+
+    def _prune(self, form, mask):
+        """Return form with the fields mask leaves out cleared."""
+        try:
+            return fieldmask.prune(form, mask)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+
+# - - - Conditional requests - - - - - - - - - - - - - - - -
+
+    def _etag(self, *parts):
+        """Return a strong ETag for a response determined by parts, e.g.
+        generations of the data it is built from.
+        """
+        return '"%s"' % hashlib.sha1(repr(parts)).hexdigest()
+
+
+    def _checkNotModified(self, etag):
+        """Raise NotModifiedException (HTTP 304) if the request's
+        If-None-Match header has etag.
+        """
+        header = self.request_state.headers.get('If-None-Match')
+        if header:
+            tags = [tag.strip() for tag in header.split(',')]
+            if etag in tags or 'W/' + etag in tags:
+                raise NotModifiedException('Not modified.')
+
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
+    def _copyConferenceToForm(self, conf, displayName=None):
+        """Copy relevant fields from Conference to ConferenceForm.
+
+        The organizer's display name is denormalized on the Conference, so no
+        Profile read is needed. `displayName`, if given, overrides it.
+        """
         cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
+        _copyConference(conf, cf)
         if displayName:
             setattr(cf, 'organizerDisplayName', displayName)
         cf.check_initialized()
         return cf
 
 
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
+    @staticmethod
+    def _conferenceData(request):
+        """Validate a ConferenceForm for a new Conference and return the
+        Conference's properties, without key and organizer. Missing fields
+        are set to their defaults, in request too.
+        """
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
+        del data['etag']
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -212,6 +450,15 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        return data
+
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user, user_id = self._getCurrentUser()
+        data = self._conferenceData(request)
+
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -220,9 +467,15 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
+        # denormalize organizer's display name onto the Conference
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            self._getProfileFromUser().displayName
+
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        ndb.put_multi([Conference(**data)] +
+                      seats.new_shards(c_key, data['seatsAvailable']))
+        self._conferencesChanged()
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
@@ -230,7 +483,7 @@ class ConferenceApi(remote.Service):
         return request
 
 
-    @ndb.transactional()
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
         user = endpoints.get_current_user()
         if not user:
@@ -254,7 +507,13 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        maxAttendees = conf.maxAttendees or 0
         for field in request.all_fields():
+            # organizerDisplayName is kept in sync with Profile only;
+            # seatsAvailable is kept in sync with the seat shards
+            if field.name in ('organizerDisplayName', 'seatsAvailable',
+                              'etag'):
+                continue
             data = getattr(request, field.name)
             # only copy fields where we get data
             if data not in (None, []):
@@ -265,9 +524,31 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+
+        # add/remove seats for a changed maxAttendees
+        delta = (conf.maxAttendees or 0) - maxAttendees
+        if delta:
+            shards = ndb.get_multi(seats.shard_keys(conf.key))
+            if None not in shards:
+                # spread over the shards, in this transaction
+                try:
+                    seats.resize(shards, delta)
+                except ValueError as e:
+                    raise endpoints.BadRequestException(
+                        'Cannot reduce maxAttendees to %d: %s'
+                        % (conf.maxAttendees or 0, e))
+                ndb.put_multi(shards)
+                self._scheduleSeatReconciliation(request.websafeConferenceKey)
+            elif (conf.seatsAvailable or 0) + delta < 0:
+                raise endpoints.BadRequestException(
+                    'Cannot reduce maxAttendees to %d: seats are taken '
+                    'already.' % (conf.maxAttendees or 0))
+            else:
+                # seats not sharded yet; shards are created from this
+                conf.seatsAvailable = (conf.seatsAvailable or 0) + delta
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        self._conferencesChanged(request.websafeConferenceKey)
+        return self._copyConferenceToForm(conf)
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -285,22 +566,57 @@ class ConferenceApi(remote.Service):
         return self._updateConferenceObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_GET_FIELDS_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName') if prof else '')
-
-
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        wsck = request.websafeConferenceKey
+        mask = self._fieldMask(request)
+        generation = get_generations(
+            [CONFERENCE_GENERATION_TPL % wsck]).values()[0]
+        self._checkNotModified(self._etag(generation, request.fieldMask))
+
+        form, generation = self._getConferenceForm(wsck, generation)
+        form = self._prune(form, mask)
+        # the form may be of a newer generation than checked
+        form.etag = self._etag(generation, request.fieldMask)
+        return form
+
+
+    def _getConferenceForm(self, websafeConferenceKey, generation=None):
+        """Return (ConferenceForm, its generation) for the conference,
+        reading through the instance cache, then memcache, then the
+        datastore.
+
+        Memcache entries are stamped with the conference's generation, so
+        they are never stale. Instance cache entries may be up to
+        CONFERENCE_CACHE_STALENESS seconds old, unless `generation`, the
+        current generation, is given.
+        """
+        wsck = websafeConferenceKey
+        cached = _conference_forms.get(wsck)
+        if cached is not None and generation in (None, cached[0]):
+            generation, encoded = cached
+        else:
+            cache_key = MEMCACHE_CONFERENCE_FORM_TPL % wsck
+            encoded, generation = get_versioned(
+                cache_key, CONFERENCE_GENERATION_TPL % wsck)
+            if encoded is None:
+                # get Conference object from request; bail if not found
+                conf = ndb.Key(urlsafe=wsck).get()
+                if not conf:
+                    raise endpoints.NotFoundException(
+                        'No conference found with key: %s' % wsck)
+                encoded = protojson.encode_message(
+                    self._copyConferenceToForm(conf))
+                set_versioned(cache_key, encoded, generation,
+                              CONFERENCE_FORM_CACHE_TTL)
+            _conference_forms.put(wsck, (generation, encoded))
+        return protojson.decode_message(ConferenceForm, encoded), generation
+
+
+    @endpoints.method(FIELD_MASK_REQUEST, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
     def getConferencesCreated(self, request):
@@ -313,59 +629,114 @@ class ConferenceApi(remote.Service):
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
-        )
+        return self._prune(ConferenceForms(
+            items=[self._copyConferenceToForm(conf) for conf in confs]
+        ), self._fieldMask(request))
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+    def _getQuery(self, inequality_fields, filters):
+        """Return (query, plan) built from filters formatted by
+        _formatFilters(). plan describes how the query is run.
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+        The datastore allows inequalities on only one field. If filters have
+        inequalities on several fields, MultiPropInequality runs the one
+        estimated to match the fewest conferences in the datastore and applies
+        the rest as post filters.
+        """
+        q = Conference.query()
 
+        inequality_nodes = []
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
+            if filtr["operator"] != "=":
+                inequality_nodes.append(formatted_query)
+            else:
+                q = q.filter(formatted_query)
+
+        if len(inequality_fields) > 1:
+            # selectivity hints for fields without sampled statistics
+            hints = dict(
+                (field, self._estimateSelectivity(
+                    [f for f in filters if f["field"] == field]))
+                for field in inequality_fields)
+            q = MultiPropInequality(q.order(Conference.name), hints=hints) \
+                    .filter(*inequality_nodes)
+            return q, q.explain()
+
+        # If exists, sort on inequality filter first. The key comes last, as
+        # queries with != are run as several queries, which can only be
+        # paged with cursors when sorted by key.
+        if not inequality_fields:
+            q = q.order(Conference.name, Conference.key)
+        else:
+            q = q.order(ndb.GenericProperty(inequality_fields[0]))
+            q = q.order(Conference.name, Conference.key)
+
+        for formatted_query in inequality_nodes:
             q = q.filter(formatted_query)
-        return q
+        return q, 'datastore: %r; post filters: none' % q
+
+
+    @staticmethod
+    def _estimateSelectivity(filters):
+        """Return the estimated fraction of conferences that match all of the
+        given formatted filters.
+        """
+        selectivity = 1.0
+        for filtr in filters:
+            op, value = filtr["operator"], filtr["value"]
+            if filtr["field"] == "month":
+                # months are assumed to be evenly spread over the year
+                matching = {
+                    '=':  1,
+                    '!=': 11,
+                    '<':  value - 1,
+                    '<=': value,
+                    '>':  12 - value,
+                    '>=': 13 - value,
+                }[op]
+                selectivity *= min(max(matching, 0), 12) / 12.0
+            else:
+                selectivity *= DEFAULT_SELECTIVITY[op]
+        return selectivity
 
 
     def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+        """Parse, check validity and format user supplied filters.
+
+        Returns (inequality_fields, formatted_filters); inequality_fields
+        lists the fields with inequality filters in the order first used.
+        """
         formatted_filters = []
-        inequality_field = None
+        inequality_fields = []
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
 
             try:
                 filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
+                # accept both operator names and symbols (e.g. GTEQ or >=)
+                if filtr["operator"] not in OPERATORS.values():
+                    filtr["operator"] = OPERATORS[filtr["operator"]]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on '%s' requires a number." % filtr["field"])
+
             # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
+            # track the fields on which inequality operations are performed
+            if filtr["operator"] != "=" and \
+                    filtr["field"] not in inequality_fields:
+                inequality_fields.append(filtr["field"])
 
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+        return (inequality_fields, formatted_filters)
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
@@ -374,52 +745,174 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            if profile:
-                names[profile.key.id()] = profile.displayName
+        if request.pageSize is not None and request.pageSize <= 0:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number.")
+        inequality_fields, filters = self._formatFilters(request.filters)
+        mask = self._fieldMask(request)
+
+        # serve repeated queries from memcache; whole responses are cached
+        # and pruned by the field mask afterwards
+        cache_key = self._queryCacheKey(filters, request)
+        cached, generation = get_versioned(cache_key, CONFERENCE_GENERATION)
+        if cached is not None:
+            return self._prune(
+                protojson.decode_message(ConferenceForms, cached), mask)
+
+        query, plan = self._getQuery(inequality_fields, filters)
+
+        # run the query once; fetch a single page if pageSize is given
+        next_cursor = None
+        if request.pageSize:
+            # multi-property inequality queries have their own cursors
+            cursor_class = MultiCursor \
+                if isinstance(query, MultiPropInequality) else Cursor
+            try:
+                start_cursor = cursor_class(urlsafe=request.cursor) \
+                    if request.cursor else None
+                conferences, cursor, more = query.fetch_page(
+                    min(request.pageSize, MAX_PAGE_SIZE),
+                    start_cursor=start_cursor)
+            except BadValueError:
+                raise endpoints.BadRequestException("Invalid cursor.")
+            except (BadArgumentError, BadRequestError) as e:
+                # the query cannot be paged with cursors
+                raise endpoints.BadRequestException(
+                    "Cannot page this query: %s" % e)
+            if more and cursor:
+                next_cursor = cursor.urlsafe()
+        else:
+            conferences = list(query)
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId, '')) for conf in \
-                conferences]
+        forms = ConferenceForms(
+                items=[self._copyConferenceToForm(conf) for conf in conferences],
+                nextCursor=next_cursor,
+                queryPlan=plan if request.debug else None
         )
+        set_versioned(cache_key, protojson.encode_message(forms), generation,
+                      QUERY_CACHE_TTL)
+        return self._prune(forms, mask)
+
+
+    @staticmethod
+    def _queryCacheKey(filters, request):
+        """Return memcache key for the result of queryConferences.
+
+        Filters formatted by _formatFilters() are reduced to a sorted set of
+        (field, operator, value), so filter order, duplicates and operator
+        aliases do not produce different keys.
+        """
+        canonical = sorted(set(
+            (f["field"], f["operator"], f["value"]) for f in filters))
+        signature = repr((canonical, request.pageSize, request.cursor,
+                          bool(request.debug)))
+        return MEMCACHE_QUERY_KEY_TPL % hashlib.sha1(signature).hexdigest()
+
+
+    @staticmethod
+    def _conferencesChanged(*websafeConferenceKeys):
+        """Invalidate cached conference query results and the cached forms
+        of the given conferences. Call after any write to a Conference;
+        inside a transaction it runs once committed.
+
+        Query results are eventually consistent, so results cached just
+        after the write may not include it; they are invalidated again by
+        an invalidate_conference_queries task.
+        """
+        def invalidate():
+            bump_generations([CONFERENCE_GENERATION] +
+                [CONFERENCE_GENERATION_TPL % wsck
+                    for wsck in websafeConferenceKeys])
+            for wsck in websafeConferenceKeys:
+                _conference_forms.pop(wsck)
+            ConferenceApi._scheduleQueryInvalidation()
+
+        ndb.get_context().call_on_commit(invalidate)
+
+
+    @staticmethod
+    def _scheduleQueryInvalidation():
+        """Enqueue an invalidate_conference_queries task to run at least
+        QUERY_CONSISTENCY_DELAY after now. Tasks are named per
+        QUERY_CONSISTENCY_DELAY window, so a burst of writes is followed by
+        one invalidation.
+        """
+        now = time.time()
+        window = int(now // QUERY_CONSISTENCY_DELAY)
+        try:
+            taskqueue.add(url='/tasks/invalidate_conference_queries',
+                name='conference-queries-%d' % window,
+                countdown=(window + 2) * QUERY_CONSISTENCY_DELAY - now
+            )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    def _invalidateConferenceQueries():
+        """Invalidate cached conference query results. Used by the
+        invalidate_conference_queries task.
+        """
+        bump_generation(CONFERENCE_GENERATION)
 
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
-        """Copy relevant fields from Profile to ProfileForm."""
+    def _copyProfileToForm(self, prof, registrations=True):
+        """Copy relevant fields from Profile to ProfileForm. Registrations are
+        only listed in conferenceKeysToAttend if `registrations` is True.
+        """
         # copy relevant fields from Profile to ProfileForm
         pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
+        _copyProfile(prof, pf)
+        pf.conferenceKeysToAttend = self._getConferenceKeysToAttend(prof) \
+                                        if registrations else []
         pf.check_initialized()
         return pf
 
 
+    @staticmethod
+    def _getConferenceKeysToAttend(prof):
+        """Return websafe keys of the conferences the user registered for.
+
+        Registrations are Registration entities under the Profile; keys still
+        in the legacy Profile.conferenceKeysToAttend list (not yet moved by
+        the migrate_registrations job) are included too.
+        """
+        wscks = list(prof.conferenceKeysToAttend)
+        for reg_key in Registration.query(ancestor=prof.key) \
+                .iter(keys_only=True):
+            if reg_key.id() not in wscks:
+                wscks.append(reg_key.id())
+        return wscks
+
+
+    def _getCurrentUser(self):
+        """Return (user, user id) of the authenticated user. Looked up once
+        per request, as the service is instantiated per request.
+        """
+        if getattr(self, '_currentUser', None) is None:
+            # make sure user is authed
+            user = endpoints.get_current_user()
+            if not user:
+                raise endpoints.UnauthorizedException('Authorization required')
+            self._currentUser = (user, getUserId(user))
+        return self._currentUser
+
+
     def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        """Return user Profile from datastore, creating new one if non-existent.
+
+        The Profile is kept for the rest of the request, so it is read at most
+        once; across requests, ndb serves it from memcache.
+        """
+        if getattr(self, '_profile', None) is not None:
+            return self._profile
 
         # get Profile from datastore
-        user_id = getUserId(user)
+        user, user_id = self._getCurrentUser()
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
         # create new Profile if not there
@@ -432,6 +925,7 @@ class ConferenceApi(remote.Service):
             )
             profile.put()
 
+        self._profile = profile
         return profile      # return Profile
 
 
@@ -439,6 +933,7 @@ class ConferenceApi(remote.Service):
         """Get user Profile and return to user, possibly updating it first."""
         # get user Profile
         prof = self._getProfileFromUser()
+        old_display_name = prof.displayName
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
@@ -453,10 +948,72 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, val)
                         prof.put()
 
+            # propagate new display name to the user's conferences
+            if prof.displayName != old_display_name:
+                taskqueue.add(params={'userId': prof.key.id()},
+                    url='/tasks/update_organizer_name'
+                )
+
         # return ProfileForm
         return self._copyProfileToForm(prof)
 
 
+    @staticmethod
+    def _updateOrganizerDisplayName(user_id, websafeCursor=None):
+        """Copy the Profile's displayName onto a page of Conferences organized
+        by the user; chains a task for the next page. Used by the
+        update_organizer_name task.
+        """
+        prof = ndb.Key(Profile, user_id).get()
+        if not prof:
+            return
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        confs, cursor, more = Conference.query(ancestor=prof.key) \
+            .fetch_page(DENORMALIZE_BATCH_SIZE, start_cursor=cursor)
+
+        stale = [conf for conf in confs
+                    if conf.organizerDisplayName != prof.displayName]
+        for conf in stale:
+            conf.organizerDisplayName = prof.displayName
+        if stale:
+            ndb.put_multi(stale)
+            ConferenceApi._conferencesChanged(
+                *[conf.key.urlsafe() for conf in stale])
+
+        if more and cursor:
+            taskqueue.add(params={'userId': user_id,
+                'cursor': cursor.urlsafe()},
+                url='/tasks/update_organizer_name'
+            )
+
+
+    @staticmethod
+    def _backfillOrganizerDisplayNames(websafeCursor=None):
+        """Set organizerDisplayName on a page of existing Conferences from
+        their organizers' Profiles; chains a task for the next page.
+        """
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        confs, cursor, more = Conference.query() \
+            .fetch_page(DENORMALIZE_BATCH_SIZE, start_cursor=cursor)
+
+        profiles = ndb.get_multi([conf.key.parent() for conf in confs])
+        stale = []
+        for conf, prof in zip(confs, profiles):
+            displayName = prof.displayName if prof else ''
+            if conf.organizerDisplayName != displayName:
+                conf.organizerDisplayName = displayName
+                stale.append(conf)
+        if stale:
+            ndb.put_multi(stale)
+            ConferenceApi._conferencesChanged(
+                *[conf.key.urlsafe() for conf in stale])
+
+        if more and cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/backfill_organizer_names'
+            )
+
+
     @endpoints.method(message_types.VoidMessage, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
     def getProfile(self, request):
@@ -473,29 +1030,71 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _announcement(conferences):
+        """Return the announcement of almost sold out conferences, a dict
+        {websafe key: name}."""
+        if not conferences:
+            return ""
+        return ANNOUNCEMENT_TPL % ', '.join(sorted(conferences.values()))
+
+
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Store the almost sold out conferences & drop the Announcement from
+        memcache; used by memcache cron job. Updates on registration keep
+        both current; this reconciles them, unless a registration changed
+        them while the conferences were queried.
         """
+        key = ndb.Key(AlmostSoldOut, ALMOST_SOLD_OUT_ID)
+        # ndb stamps AlmostSoldOut.updated in UTC
+        started = datetime.utcnow()
         confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable <= ANNOUNCEMENT_SEATS,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
+        conferences = dict((conf.key.urlsafe(), conf.name) for conf in confs)
+
+        @ndb.transactional()
+        def update():
+            stored = key.get()
+            if stored and stored.updated and stored.updated >= started:
+                return False
+            AlmostSoldOut(key=key, conferences=conferences).put()
+            return True
+        if update():
             memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
 
-        return announcement
+
+    @staticmethod
+    def _seatsChanged(websafeConferenceKey, name, seatsAvailable):
+        """Add the conference to, or remove it from, the almost sold out
+        conferences, by its seatsAvailable, and drop the Announcement from
+        memcache if they changed; getAnnouncement() rebuilds it.
+        """
+        almost = 0 < seatsAvailable <= ANNOUNCEMENT_SEATS
+        key = ndb.Key(AlmostSoldOut, ALMOST_SOLD_OUT_ID)
+        stored = key.get()
+        if stored and \
+                (websafeConferenceKey in (stored.conferences or {})) == almost:
+            return
+
+        @ndb.transactional()
+        def update():
+            stored = key.get() or AlmostSoldOut(key=key)
+            stored.conferences = dict(stored.conferences or {})
+            if (websafeConferenceKey in stored.conferences) != almost:
+                if almost:
+                    stored.conferences[websafeConferenceKey] = name
+                else:
+                    del stored.conferences[websafeConferenceKey]
+                stored.put()
+                return True
+            return False
+        # deleted rather than set, so concurrent updates committed in one
+        # order cannot be cached in the other
+        if update():
+            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
 
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
@@ -503,14 +1102,27 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if announcement is None:
+            stored = ndb.Key(AlmostSoldOut, ALMOST_SOLD_OUT_ID).get()
+            announcement = self._announcement(
+                stored.conferences if stored else None)
+            memcache.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        etag = self._etag(announcement)
+        self._checkNotModified(etag)
+        return StringMessage(data=announcement, etag=etag)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
-        """Register or unregister user for selected conference."""
+        """Register or unregister user for selected conference.
+
+        Seats are reserved from the conference's sharded seat counter (see
+        seats.py), so registrations do not write the Conference entity;
+        seatsAvailable is reconciled by the reconcile_seats task. The
+        Announcement is updated when the seats left cross its threshold.
+        """
         retval = None
         prof = self._getProfileFromUser() # get user Profile
 
@@ -525,59 +1137,214 @@ class ConferenceApi(remote.Service):
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if wsck in prof.conferenceKeysToAttend or \
+                    ndb.Key(Registration, wsck, parent=prof.key).get():
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # register user, take away one seat from a shard with free seats
+            for shard_key in seats.open_shard_keys(conf):
+                if self._reserveSeat(prof.key, wsck, shard_key):
+                    retval = True
+                    break
+            else:
+                # check if seats avail
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
-
         # unregister
         else:
-            # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            # unregister user, add back one seat; conferences nobody has
+            # registered for since seats were sharded have no shards yet
+            seats.get_shards(conf)
+            retval = self._releaseSeat(prof.key, wsck)
+
+        # the transaction may have changed the Profile
+        self._profile = None
+        if retval:
+            self._scheduleSeatReconciliation(wsck)
+            shards = ndb.get_multi(seats.shard_keys(conf.key))
+            if None not in shards:
+                self._seatsChanged(wsck, conf.name, seats.available(shards))
+        return BooleanMessage(data=retval)
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _reserveSeat(p_key, wsck, shard_key):
+        """Register the user for the conference, taking a seat from the
+        shard. Returns False if the shard has no free seats.
+        """
+        reg_key = ndb.Key(Registration, wsck, parent=p_key)
+        prof, registration, shard = ndb.get_multi([p_key, reg_key, shard_key])
+        # check if user already registered otherwise add
+        if registration or wsck in prof.conferenceKeysToAttend:
+            raise ConflictException(
+                "You have already registered for this conference")
+        if not seats.take(shard):
+            return False
+        ndb.put_multi([
+            Registration(key=reg_key, conference=ndb.Key(urlsafe=wsck),
+                         seatShard=shard_key.id()),
+            shard
+        ])
+        return True
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _releaseSeat(p_key, wsck):
+        """Unregister the user from the conference, giving the seat back to
+        the shard it was taken from. Returns False if the user is not
+        registered.
+        """
+        reg_key = ndb.Key(Registration, wsck, parent=p_key)
+        prof, registration = ndb.get_multi([p_key, reg_key])
+        shard = seats.release_shard_key(
+            ndb.Key(urlsafe=wsck), registration).get()
+        # check if user already registered
+        if registration:
+            reg_key.delete()
+        elif wsck in prof.conferenceKeysToAttend:
+            prof.conferenceKeysToAttend.remove(wsck)
+            prof.put()
+        else:
+            return False
+        seats.give(shard)
+        shard.put()
+        return True
+
+
+    @staticmethod
+    def _migrateRegistrations(websafeCursor=None):
+        """Move a page of Profiles' conferenceKeysToAttend lists to
+        Registration entities; chains a task for the next page.
+        """
+        cursor = Cursor(urlsafe=websafeCursor) if websafeCursor else None
+        p_keys, cursor, more = Profile.query().fetch_page(
+            DENORMALIZE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+
+        @ndb.transactional()
+        def migrate(p_key):
+            prof = p_key.get()
+            if not prof.conferenceKeysToAttend:
+                return
+            ndb.put_multi([
+                Registration(key=ndb.Key(Registration, wsck, parent=p_key),
+                             conference=ndb.Key(urlsafe=wsck))
+                for wsck in set(prof.conferenceKeysToAttend)
+            ])
+            prof.conferenceKeysToAttend = []
+            prof.put()
+
+        for p_key in p_keys:
+            migrate(p_key)
+
+        if more and cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/migrate_registrations'
+            )
+
+
+    @staticmethod
+    def _scheduleSeatReconciliation(websafeConferenceKey):
+        """Enqueue a reconcile_seats task for the conference. Tasks are named
+        per SEAT_RECONCILE_DELAY window, so a burst of registrations is
+        reconciled once.
+        """
+        window = int(time.time() // SEAT_RECONCILE_DELAY)
+        try:
+            taskqueue.add(params={'websafeConferenceKey': websafeConferenceKey},
+                url='/tasks/reconcile_seats',
+                name='seats-%s-%d' % (websafeConferenceKey, window),
+                countdown=SEAT_RECONCILE_DELAY
+            )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
+    @staticmethod
+    def _reconcileSeats(websafeConferenceKey):
+        """Copy the free seats counted by the seat shards to the Conference's
+        seatsAvailable. Used by the reconcile_seats task.
+        """
+        conf_key = ndb.Key(urlsafe=websafeConferenceKey)
+        shards = ndb.get_multi(seats.shard_keys(conf_key))
+        if None in shards:
+            return
+        seatsAvailable = seats.available(shards)
+
+        @ndb.transactional()
+        def update():
+            conf = conf_key.get()
+            if conf and conf.seatsAvailable != seatsAvailable:
+                conf.seatsAvailable = seatsAvailable
+                conf.put()
+                ConferenceApi._conferencesChanged(websafeConferenceKey)
+            return conf
+
+        # also catches seats changed by updating maxAttendees
+        conf = update()
+        if conf:
+            ConferenceApi._seatsChanged(websafeConferenceKey, conf.name,
+                                        seatsAvailable)
+
+
+    @endpoints.method(FIELD_MASK_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
+        conf_keys = [ndb.Key(urlsafe=wsck)
+                        for wsck in self._getConferenceKeysToAttend(prof)]
         conferences = ndb.get_multi(conf_keys)
 
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        # return set of ConferenceForm objects per Conference
+        return self._prune(ConferenceForms(items=[self._copyConferenceToForm(conf) \
+         for conf in conferences if conf]
+        ), self._fieldMask(request))
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
 
-        # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+    @endpoints.method(CONF_ATTENDEES_REQUEST, ProfileForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return a page of profiles registered for the conference; only
+        available to the conference owner.
+        """
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        wsck = request.websafeConferenceKey
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees of the conference.')
+
+        try:
+            start_cursor = Cursor(urlsafe=request.cursor) \
+                if request.cursor else None
+            reg_keys, cursor, more = Registration.query(
+                    Registration.conference == conf.key) \
+                .fetch_page(
+                    min(request.pageSize or MAX_PAGE_SIZE, MAX_PAGE_SIZE),
+                    start_cursor=start_cursor, keys_only=True)
+        except (BadValueError, BadArgumentError, BadRequestError):
+            # cursors of other queries fail when the query is run
+            raise endpoints.BadRequestException("Invalid cursor.")
+        profiles = ndb.get_multi([reg_key.parent() for reg_key in reg_keys])
+
+        return ProfileForms(
+            items=[self._copyProfileToForm(prof, registrations=False)
+                    for prof in profiles if prof],
+            nextCursor=cursor.urlsafe() if more and cursor else None
         )
 
 
@@ -620,22 +1387,16 @@ class ConferenceApi(remote.Service):
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
         speaker_form = SpeakerForm()
-        for field in speaker_form.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(speaker_form, field.name, getattr(speaker, field.name))
-            elif field.name == 'websafeKey':
-                setattr(speaker_form, field.name, speaker.key.urlsafe())
+        _copySpeaker(speaker, speaker_form)
         speaker_form.check_initialized()
         return speaker_form
 
 
-    def _createSpeakerObject(self, request):
-        """Create or update Speaker object, returning Speaker/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
+    @staticmethod
+    def _speakerData(request):
+        """Validate a SpeakerForm for a new Speaker and return the Speaker's
+        properties. Missing fields are set to their defaults, in request too.
+        """
         if not request.name:
             raise endpoints.BadRequestException("Speaker 'name' field required")
 
@@ -649,9 +1410,20 @@ class ConferenceApi(remote.Service):
             if data.get(df, None) is None:
                 data[df] = DEFAULTS_SPEAKER[df]
                 setattr(request, df, DEFAULTS_SPEAKER[df])
+        return data
+
+
+    def _createSpeakerObject(self, request):
+        """Create or update Speaker object, returning Speaker/request."""
+        # preload necessary data items
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        data = self._speakerData(request)
 
         # create Speaker and return updated SpeakerForm with websafeKey
         request.websafeKey = Speaker(**data).put().urlsafe()
+        bump_generation(SPEAKERS_GENERATION)
         return request
 
 
@@ -675,6 +1447,12 @@ class ConferenceApi(remote.Service):
             if data is not None:
                 setattr(speaker, field.name, data)
         speaker.put()
+        bump_generation(SPEAKERS_GENERATION)
+
+        # rebuild the schedules the speaker is embedded in
+        taskqueue.add(params={'websafeSpeakerKey': request.websafeSpeakerKey},
+            url='/tasks/rebuild_schedule'
+        )
         return self._copySpeakerToForm(speaker)
 
 
@@ -712,45 +1490,135 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getAllSpeakers')
     def getAllSpeakers(self, request):
         """Return all speakers."""
+        etag = self._etag(
+            get_generations([SPEAKERS_GENERATION]).values()[0])
+        self._checkNotModified(etag)
         speakers = Speaker.query()
 
         return SpeakerForms(
-            items=[self._copySpeakerToForm(speaker) for speaker in speakers]
+            items=[self._copySpeakerToForm(speaker) for speaker in speakers],
+            etag=etag
         )
 
 
 # - - - Featured Speaker - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _countSpeakerSessions(sessions):
+        """Add new sessions of a conference to the SpeakerSessionCounts of
+        their speakers. Call in a transaction on the conference. Sessions
+        counted already are skipped, so a retried call counts them once.
+        """
+        if not sessions:
+            return
+        conf_key = sessions[0].key.parent()
+        wssks = sorted(set(session.websafeSpeakerKey for session in sessions))
+        counters = dict(zip(wssks, ndb.get_multi(
+            [ndb.Key(SpeakerSessionCount, wssk, parent=conf_key)
+                for wssk in wssks])))
+
+        def add(counter, session):
+            wsk = session.key.urlsafe()
+            if wsk not in counter.sessionKeys:
+                counter.sessionKeys.append(wsk)
+                counter.sessionNames.append(session.name)
+                counter.count = len(counter.sessionKeys)
+
+        for wssk in wssks:
+            if counters[wssk] is None:
+                # the speaker's first count in the conference starts from
+                # the sessions stored before counting began
+                counters[wssk] = SpeakerSessionCount(id=wssk, parent=conf_key)
+                for session in Session.query(ancestor=conf_key) \
+                        .filter(Session.websafeSpeakerKey==wssk):
+                    add(counters[wssk], session)
+        for session in sessions:
+            add(counters[session.websafeSpeakerKey], session)
+        ndb.put_multi(counters.values())
+
+
+    @staticmethod
+    def _checkSpeakerLater(websafeSpeakerKey, websafeConferenceKey):
+        """Enqueue a check_speaker task to run at the end of the current
+        CHECK_SPEAKER_WINDOW. Tasks are named after the speaker, conference
+        and window, so all checks within a window coalesce into one task,
+        which runs after them.
+        """
+        now = time.time()
+        window = int(now // CHECK_SPEAKER_WINDOW)
+        name = 'check-speaker-%s-%d' % (hashlib.sha1(
+            websafeSpeakerKey + websafeConferenceKey).hexdigest(), window)
+        try:
+            taskqueue.add(name=name,
+                params={
+                    'websafeSpeakerKey': websafeSpeakerKey,
+                    'websafeConferenceKey': websafeConferenceKey
+                },
+                url='/tasks/check_speaker',
+                countdown=(window + 1) * CHECK_SPEAKER_WINDOW - now
+            )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
+
+
     @staticmethod
     def _should_feature_speaker(websafeSpeakerKey, websafeConferenceKey):
         """Check if speaker has more than one sessions in the conference.
-        If so, set the speaker as featured with session names.
+        If so, set the speaker as featured with session names, for the
+        conference and overall.
         """
-
         conference_key = ndb.Key(urlsafe=websafeConferenceKey)
-        sessions = Session.query(ancestor=conference_key) \
-            .filter(Session.websafeSpeakerKey==websafeSpeakerKey)
-
-        s_names = []
-        for session in sessions:
-            s_names.append(session.name)
+        counter = ndb.Key(SpeakerSessionCount, websafeSpeakerKey,
+                          parent=conference_key).get()
 
-        if len(s_names) > 1:
+        if counter and counter.count > 1:
             speaker = ndb.Key(urlsafe=websafeSpeakerKey).get()
             if speaker:
-                featured_speaker = 'Featured Speaker: {} \n Sessions: {}' \
-                    .format(speaker.name, ', '.join(s_names))
-                memcache.set(MEMCACHE_FEATURED_SPEAKER_KEY, featured_speaker)
+                featured_speaker = FEATURED_SPEAKER_TPL.format(
+                    speaker.name, ', '.join(counter.sessionNames))
+                memcache.set_multi({
+                    MEMCACHE_FEATURED_SPEAKER_KEY: featured_speaker,
+                    MEMCACHE_FEATURED_SPEAKER_TPL % websafeConferenceKey:
+                        featured_speaker
+                })
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @staticmethod
+    def _featuredSpeakerOf(websafeConferenceKey):
+        """Return the featured speaker text of the speaker with the most
+        sessions in the conference, or '' if no speaker has more than one.
+        """
+        counters = SpeakerSessionCount.query(
+            ancestor=ndb.Key(urlsafe=websafeConferenceKey)).fetch()
+        counter = max(counters, key=lambda counter: counter.count) \
+            if counters else None
+        if counter and counter.count > 1:
+            speaker = ndb.Key(urlsafe=counter.key.id()).get()
+            if speaker:
+                return FEATURED_SPEAKER_TPL.format(
+                    speaker.name, ', '.join(counter.sessionNames))
+        return ''
+
+
+    @endpoints.method(FEATURED_SPEAKER_REQUEST, StringMessage,
             path='speaker/featured/get',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Returns the featured speaker from memcache"""
-        return StringMessage(
-            data=memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or ''
-        )
+        """Returns the featured speaker from memcache, of the conference
+        websafeConferenceKey if given"""
+        wsck = request.websafeConferenceKey
+        if wsck:
+            cache_key = MEMCACHE_FEATURED_SPEAKER_TPL % wsck
+            featured = memcache.get(cache_key)
+            if featured is None:
+                featured = self._featuredSpeakerOf(wsck)
+                memcache.add(cache_key, featured)
+        else:
+            featured = memcache.get(MEMCACHE_FEATURED_SPEAKER_KEY) or ''
+        etag = self._etag(featured)
+        self._checkNotModified(etag)
+        return StringMessage(data=featured, etag=etag)
 
 
 # - - - Session objects - - - - - - - - - - - - - - - - -
@@ -772,108 +1640,135 @@ class ConferenceApi(remote.Service):
         `conference` is present, a `ConferenceForm` is generated from
         conference. If both are present, `confForm` takes precedence. If none of
         them are supplied, conference object is fetched from datastore using
-        the parent attribute of session. `displayName` is processed the same way
-        as `conference`.
+        the parent attribute of session. `displayName`, if given, overrides the
+        organizer display name stored on the conference.
         """
         session_form = SessionForm()
-        for field in session_form.all_fields():
-            if hasattr(session, field.name):
-                # covert date and time to string
-                if field.name in ('date', 'startTime'):
-                    setattr(
-                        session_form,
-                        field.name,
-                        str(getattr(session, field.name))
-                    )
-                # covert typeOfSession to enum
-                elif field.name == 'typeOfSession':
-                    setattr(
-                        session_form,
-                        field.name,
-                        getattr(SessionType, getattr(session, field.name))
-                    )
-                # just copy the rest
-                else:
-                    setattr(
-                        session_form,
-                        field.name,
-                        getattr(session, field.name)
-                    )
-            # Generate websafe key
-            elif field.name == 'websafeKey':
-                setattr(session_form, field.name, session.key.urlsafe())
-            # Generate speaker form
-            elif field.name == 'speaker':
-                s_speakerForm = speakerForm
-                if not s_speakerForm:
-                    s_speaker = speaker if speaker else \
-                            ndb.Key(urlsafe=getattr(
-                                                session,
-                                                'websafeSpeakerKey')
-                            ).get()
-                    if s_speaker:
-                        s_speakerForm = self._copySpeakerToForm(s_speaker)
-                if s_speakerForm:
-                    setattr(session_form, field.name, s_speakerForm)
-            # Generate conference form
-            elif field.name == 'conference':
-                s_conferenceForm = confForm
-                if not s_conferenceForm:
-                    s_conf = conference if conference else \
-                                session.key.parent().get()
-                    conf_disp_name = displayName
-                    if not conf_disp_name and s_conf:
-                        prof = s_conf.key.parent().get()
-                        conf_disp_name = getattr(prof, 'displayName') \
-                                            if prof else ''
-                    if s_conf:
-                        s_conferenceForm = self._copyConferenceToForm(
-                                                s_conf,
-                                                conf_disp_name
-                                            )
-                if s_conferenceForm:
-                    setattr(session_form, field.name, s_conferenceForm)
+        _copySession(session, session_form)
+
+        # Generate speaker form
+        s_speakerForm = speakerForm
+        if not s_speakerForm:
+            s_speaker = speaker if speaker else \
+                    ndb.Key(urlsafe=getattr(
+                                        session,
+                                        'websafeSpeakerKey')
+                    ).get()
+            if s_speaker:
+                s_speakerForm = self._copySpeakerToForm(s_speaker)
+        if s_speakerForm:
+            session_form.speaker = s_speakerForm
+
+        # Generate conference form
+        s_conferenceForm = confForm
+        if not s_conferenceForm:
+            s_conf = conference if conference else \
+                        session.key.parent().get()
+            if s_conf:
+                s_conferenceForm = self._copyConferenceToForm(
+                                        s_conf,
+                                        displayName
+                                    )
+        if s_conferenceForm:
+            session_form.conference = s_conferenceForm
         session_form.check_initialized()
         return session_form
 
 
-    def _createSessionObject(self, request):
-        """Create or update Session object, returning SessionForm/request."""
-        # check logged in user
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
-
-        # get target conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found for key: {}' \
-                    .format(request.websafeConferenceKey))
+    def _getMulti(self, keys):
+        """Return the entities for keys. Each key is read at most once per
+        request, with one get_multi for all keys not read yet.
+        """
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            loaded = self._loaded = {}
+        missing = list(set(key for key in keys if key not in loaded))
+        for key, entity in zip(missing, ndb.get_multi(missing)):
+            loaded[key] = entity
+        return [loaded[key] for key in keys]
+
+
+    def _copySessionsToForms(self, sessions, speakerForm=None, confForm=None,
+                             mask=None):
+        """Copy Sessions to SessionForms.
+
+        Speakers, conferences and (for conferences without a denormalized
+        organizer name) organizer Profiles of all sessions are read with one
+        get_multi per kind, and each form is built once. `speakerForm` and
+        `confForm`, if given, are attached to every SessionForm instead.
+        Speakers and conferences are not read at all if the field mask of
+        the SessionForms, `mask`, leaves them out.
+        """
+        sessions = [session for session in sessions if session]
+        withSpeaker = fieldmask.selects(mask, 'speaker')
+        withConference = fieldmask.selects(mask, 'conference')
+
+        speakerForms = {}
+        if withSpeaker and not speakerForm:
+            s_keys = [ndb.Key(urlsafe=session.websafeSpeakerKey)
+                        for session in sessions if session.websafeSpeakerKey]
+            for speaker in self._getMulti(s_keys):
+                if speaker and speaker.key not in speakerForms:
+                    speakerForms[speaker.key] = self._copySpeakerToForm(speaker)
+
+        confForms = {}
+        if withConference and not confForm:
+            c_keys = [session.key.parent() for session in sessions]
+            confs = [conf for conf in self._getMulti(c_keys) if conf]
+            p_keys = [conf.key.parent() for conf in confs
+                        if not conf.organizerDisplayName]
+            displayNames = dict((prof.key, prof.displayName)
+                                for prof in self._getMulti(p_keys) if prof)
+            for conf in confs:
+                if conf.key not in confForms:
+                    confForms[conf.key] = self._copyConferenceToForm(
+                        conf, displayNames.get(conf.key.parent()))
+
+        forms = []
+        for session in sessions:
+            session_form = SessionForm()
+            _copySession(session, session_form)
+            if withSpeaker:
+                session_form.speaker = speakerForm or \
+                    speakerForms.get(ndb.Key(urlsafe=session.websafeSpeakerKey))
+            if withConference:
+                session_form.conference = confForm or \
+                    confForms.get(session.key.parent())
+            session_form.check_initialized()
+            forms.append(session_form)
+        return forms
+
+
+    def _sessionForms(self, request, sessions, speakerForm=None,
+                      confForm=None, **fields):
+        """Return SessionForms of sessions, with other `fields` of the
+        message, pruned by the request's fieldMask. Sessions are not read if
+        the mask leaves out the items.
+        """
+        mask = self._fieldMask(request)
+        items = []
+        if fieldmask.selects(mask, 'items'):
+            items = self._copySessionsToForms(
+                sessions, speakerForm, confForm,
+                mask=fieldmask.submask(mask, 'items'))
+        return self._prune(SessionForms(items=items, **fields), mask)
 
-        # check that user is owner of conference
-        if user_id != conf.organizerUserId:
-            raise endpoints.ForbiddenException(
-                'Only the owner can create sessions for the conference.')
 
+    @staticmethod
+    def _sessionData(request, conf):
+        """Validate a SessionEditForm for a new Session in the Conference
+        conf and return the Session's properties, without key.
+        """
         # copy Session/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) \
                     for field in request.all_fields()}
-        del data['websafeConferenceKey']
+        data.pop('websafeConferenceKey', None)
 
         # add default values for missing fields
         for df in DEFAULTS_SESSION:
             if data[df] in (None, []):
                 data[df] = DEFAULTS_SESSION[df]
 
-        # check if specified speaker exists
-        speaker = ndb.Key(urlsafe=data['websafeSpeakerKey']).get()
-        if not speaker:
-            raise endpoints.NotFoundException(
-                'No speaker found for key: {}' \
-                    .format(data['websafeSpeakerKey']))
-
         # convert enum to string
         data['typeOfSession'] = str(data['typeOfSession'])
 
@@ -890,6 +1785,37 @@ class ConferenceApi(remote.Service):
             timeString = data['startTime'][:5] if len(data['startTime']) < 12 \
                             else data['startTime'][11:16]
             data['startTime'] = datetime.strptime(timeString, "%H:%M").time()
+        return data
+
+
+    def _createSessionObject(self, request):
+        """Create or update Session object, returning SessionForm/request."""
+        # check logged in user
+        user = endpoints.get_current_user()
+        if not user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = getUserId(user)
+
+        # get target conference
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found for key: {}' \
+                    .format(request.websafeConferenceKey))
+
+        # check that user is owner of conference
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can create sessions for the conference.')
+
+        data = self._sessionData(request, conf)
+
+        # check if specified speaker exists
+        speaker = ndb.Key(urlsafe=data['websafeSpeakerKey']).get()
+        if not speaker:
+            raise endpoints.NotFoundException(
+                'No speaker found for key: {}' \
+                    .format(data['websafeSpeakerKey']))
 
         # generate Session key, setting the conference as the parent
         s_id = Session.allocate_ids(size=1, parent=conf.key)[0]
@@ -897,16 +1823,24 @@ class ConferenceApi(remote.Service):
         data['key'] = s_key
 
         session_object = Session(**data)
-        session_object.put()
+
+        @ndb.transactional()
+        def put():
+            # the schedule is rebuilt with the new session by a task; until
+            # then, readers read the sessions
+            session_object.put()
+            self._countSpeakerSessions([session_object])
+            self._scheduleKey(request.websafeConferenceKey).delete()
+            taskqueue.add(
+                params={'websafeConferenceKey': request.websafeConferenceKey},
+                url='/tasks/rebuild_schedule',
+                transactional=True
+            )
+        put()
+        bump_generation(SESSIONS_GENERATION_TPL % conf.key.urlsafe())
 
         # Check if speaker should be featured
-        taskqueue.add(
-            params={
-                'websafeSpeakerKey': speaker.key.urlsafe(),
-                'websafeConferenceKey': conf.key.urlsafe()
-            },
-            url='/tasks/check_speaker'
-        )
+        self._checkSpeakerLater(speaker.key.urlsafe(), conf.key.urlsafe())
 
         return self._copySessionToForm(
             session_object,
@@ -923,44 +1857,198 @@ class ConferenceApi(remote.Service):
         return self._createSessionObject(request)
 
 
-    def _get_sessions_in_conf(self, websafeConferenceKey):
-        """Returns a query and conference form for all sessions in a conference.
-        Raises a NotFoundException if conference does not exists.
+# - - - Conference schedules - - - - - - - - - - - - - - - -
+
+    @staticmethod
+    def _scheduleKey(websafeConferenceKey):
+        """Return the key of the conference's ConferenceSchedule."""
+        return ndb.Key(ConferenceSchedule, SCHEDULE_ID,
+                       parent=ndb.Key(urlsafe=websafeConferenceKey))
+
+
+    @staticmethod
+    def _buildSchedule(websafeConferenceKey):
+        """Return (ConferenceSchedule entries, session keys, {websafe speaker
+        key: Speaker.updated}) read from the conference's sessions and
+        speakers.
         """
-        # get target conference
-        conf = ndb.Key(urlsafe=websafeConferenceKey).get()
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found for key: {}' \
-                    .format(request.websafeConferenceKey))
+        sessions = Session.query(
+            ancestor=ndb.Key(urlsafe=websafeConferenceKey)).fetch()
+        sp_keys = set(ndb.Key(urlsafe=session.websafeSpeakerKey)
+                        for session in sessions)
+        speakers = dict((speaker.key.urlsafe(), speaker)
+                        for speaker in ndb.get_multi(list(sp_keys))
+                        if speaker)
+
+        entries = []
+        for session in sessions:
+            session_form = SessionForm()
+            _copySession(session, session_form)
+            speaker = speakers.get(session.websafeSpeakerKey)
+            if speaker:
+                session_form.speaker = SpeakerForm()
+                _copySpeaker(speaker, session_form.speaker)
+            entries.append({
+                'typeOfSession': session.typeOfSession,
+                'duration': session.duration,
+                'date': session.date,
+                'startTime': session.startTime,
+                'form': protojson.encode_message(session_form)
+            })
+        entries.sort(key=_scheduleOrder)
+        return (entries, set(session.key for session in sessions),
+                dict((wssk, speaker.updated)
+                     for wssk, speaker in speakers.items()))
+
+
+    @staticmethod
+    def _rebuildSchedule(websafeConferenceKey):
+        """Build the conference's ConferenceSchedule and store it. Used by
+        the rebuild_schedule task.
+
+        The schedule is stored only if no session was added while it was
+        built, and none of its speakers is older than in the stored
+        schedule, so that it never replaces a newer one. Entries that do not
+        fit in the schedule entity go to ScheduleChunks, which are replaced
+        with it.
+        """
+        schedule_key = ConferenceApi._scheduleKey(websafeConferenceKey)
+        conf_key = schedule_key.parent()
+
+        @ndb.transactional()
+        def save(entries, s_keys, speakers):
+            current = Session.query(ancestor=conf_key).fetch(keys_only=True)
+            if set(current) != s_keys:
+                return False
+            stored = schedule_key.get()
+            if stored and _olderSpeakers(speakers, stored.speakers or {}):
+                return False
+            # chunks of earlier schedules, including deleted ones
+            ndb.delete_multi(ScheduleChunk.query(ancestor=schedule_key)
+                                          .fetch(keys_only=True))
+            chunks = _scheduleChunks(entries)
+            build = uuid.uuid4().hex
+            chunk_keys = [ndb.Key(ScheduleChunk, '%s-%d' % (build, i),
+                                  parent=schedule_key)
+                          for i in range(1, len(chunks))]
+            ndb.put_multi(
+                [ConferenceSchedule(key=schedule_key, sessions=chunks[0],
+                                    chunkIds=[key.id() for key in chunk_keys],
+                                    speakers=speakers)] +
+                [ScheduleChunk(key=key, sessions=chunk)
+                    for key, chunk in zip(chunk_keys, chunks[1:])])
+            return True
+
+        for attempt in range(SCHEDULE_BUILD_ATTEMPTS):
+            if save(*ConferenceApi._buildSchedule(websafeConferenceKey)):
+                # speakers may have changed
+                bump_generation(
+                    SESSIONS_GENERATION_TPL % websafeConferenceKey)
+                break
+        # if sessions or speakers keep changing, the task of the last change
+        # stores it
+
+
+    @staticmethod
+    def _enqueueScheduleRebuild(websafeConferenceKey):
+        """Enqueue a rebuild_schedule task for the conference. Tasks are named
+        per SCHEDULE_REBUILD_WINDOW, so readers missing the schedule at once
+        rebuild it once.
+        """
+        window = int(time.time() // SCHEDULE_REBUILD_WINDOW)
+        try:
+            taskqueue.add(params={'websafeConferenceKey': websafeConferenceKey},
+                url='/tasks/rebuild_schedule',
+                name='schedule-%s-%d' % (websafeConferenceKey, window)
+            )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
 
-        # get organizer display name
-        organizer = conf.key.parent().get()
-        displayName = getattr(organizer, 'displayName') if organizer else ''
 
-        # generate ConferenceForm once for all sessions
-        conference_form = self._copyConferenceToForm(conf, displayName)
+    @staticmethod
+    def _scheduleEntries(schedule):
+        """Return the entries of a ConferenceSchedule and its chunks, or None
+        if it is missing or was replaced while being read.
+        """
+        if schedule is None:
+            return None
+        chunks = ndb.get_multi([ndb.Key(ScheduleChunk, chunk_id,
+                                        parent=schedule.key)
+                                for chunk_id in schedule.chunkIds])
+        if None in chunks:
+            return None
+        entries = list(schedule.sessions)
+        for chunk in chunks:
+            entries.extend(chunk.sessions)
+        return entries
 
-        # create ancestor query for the target conference
-        sessions = Session.query(ancestor=conf.key)
 
-        return sessions, conference_form
+    @staticmethod
+    def _rebuildSpeakerSchedules(websafeSpeakerKey):
+        """Rebuild the schedules of the conferences the speaker has sessions
+        in. Used by the rebuild_schedule task.
+        """
+        s_keys = Session.query(
+            Session.websafeSpeakerKey==websafeSpeakerKey).fetch(keys_only=True)
+        for wsck in set(s_key.parent().urlsafe() for s_key in s_keys):
+            ConferenceApi._rebuildSchedule(wsck)
 
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    def _getSchedule(self, websafeConferenceKey, generation=None):
+        """Return the ConferenceSchedule entries and the ConferenceForm of a
+        conference. Raises a NotFoundException if conference does not exists.
+        `generation`, the conference's current generation if given, keeps
+        the ConferenceForm from being older (see _getConferenceForm()).
+        """
+        schedule = self._scheduleKey(websafeConferenceKey).get_async()
+        conference_form, generation = \
+                    self._getConferenceForm(websafeConferenceKey, generation)
+        entries = self._scheduleEntries(schedule.get_result())
+        if entries is None:
+            # stored by a task, so reads do not change the sessions' ETag;
+            # until then, read the sessions
+            self._enqueueScheduleRebuild(websafeConferenceKey)
+            entries = self._buildSchedule(websafeConferenceKey)[0]
+        return entries, conference_form
+
+
+    def _scheduleForms(self, request, entries, confForm, **fields):
+        """Return SessionForms of ConferenceSchedule entries, with other
+        `fields` of the message, pruned by the request's fieldMask.
+        """
+        mask = self._fieldMask(request)
+        items = []
+        if fieldmask.selects(mask, 'items'):
+            withConference = fieldmask.selects(
+                fieldmask.submask(mask, 'items'), 'conference')
+            for entry in entries:
+                session_form = protojson.decode_message(SessionForm,
+                                                        entry['form'])
+                if withConference:
+                    session_form.conference = confForm
+                items.append(session_form)
+        return self._prune(SessionForms(items=items, **fields), mask)
+
+
+    @endpoints.method(CONF_GET_FIELDS_REQUEST, SessionForms,
         path='session/get/conference/{websafeConferenceKey}',
         http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Returns all sessions of the specified conference"""
+        wsck = request.websafeConferenceKey
+        generations = get_generations([CONFERENCE_GENERATION_TPL % wsck,
+                                       SESSIONS_GENERATION_TPL % wsck,
+                                       SPEAKERS_GENERATION])
+        etag = self._etag(sorted(generations.items()), request.fieldMask)
+        self._checkNotModified(etag)
 
-        (sessions, conference_form) = \
-                    self._get_sessions_in_conf(request.websafeConferenceKey)
+        entries, conference_form = self._getSchedule(
+            wsck, generations[CONFERENCE_GENERATION_TPL % wsck])
 
         # return sesions
-        return SessionForms(
-            items=[self._copySessionToForm(session, confForm=conference_form) \
-                    for session in sessions]
-        )
+        return self._scheduleForms(request, entries, conference_form,
+                                   etag=etag)
 
 
     @endpoints.method(SESSION_GET_REQUEST_BY_TYPE, SessionForms,
@@ -969,19 +2057,16 @@ class ConferenceApi(remote.Service):
     def getConferenceSessionsByType(self, request):
         """Returns all session of the specified type in the conference"""
 
-        (sessions, conference_form) = \
-                    self._get_sessions_in_conf(request.websafeConferenceKey)
+        entries, conference_form = \
+                    self._getSchedule(request.websafeConferenceKey)
 
-        # filter session query by property
-        sessions = sessions.filter(
-                        Session.typeOfSession==str(request.typeOfSession)
-                   )
+        # filter schedule by property
+        typeOfSession = str(request.typeOfSession)
+        entries = [entry for entry in entries
+                    if entry['typeOfSession'] == typeOfSession]
 
          # return sesions
-        return SessionForms(
-            items=[self._copySessionToForm(session, confForm=conference_form) \
-                    for session in sessions]
-        )
+        return self._scheduleForms(request, entries, conference_form)
 
 
     @endpoints.method(SESSION_GET_REQUEST_BY_SPEAKER, SessionForms,
@@ -1005,10 +2090,7 @@ class ConferenceApi(remote.Service):
         )
 
         # return sesions
-        return SessionForms(
-            items=[self._copySessionToForm(session, speakerForm=speaker_form) \
-                    for session in sessions]
-        )
+        return self._sessionForms(request, sessions, speakerForm=speaker_form)
 
 
     @endpoints.method(SESSION_GET_REQUEST_BY_DURATION, SessionForms,
@@ -1018,19 +2100,18 @@ class ConferenceApi(remote.Service):
         """Returns all sessions in a conference that don't last longer than x
         minutes
         """
-        (sessions, conference_form) = \
-                    self._get_sessions_in_conf(request.websafeConferenceKey)
+        entries, conference_form = \
+                    self._getSchedule(request.websafeConferenceKey)
 
-        # filter session query by property
-        sessions = sessions.filter(
-                        Session.duration<=int(request.duration)
-                   )
+        # filter schedule by property; like the datastore, leave out
+        # sessions without a duration
+        duration = int(request.duration)
+        entries = [entry for entry in entries
+                    if entry['duration'] is not None and
+                        entry['duration'] <= duration]
 
          # return sesions
-        return SessionForms(
-            items=[self._copySessionToForm(session, confForm=conference_form) \
-                    for session in sessions]
-        )
+        return self._scheduleForms(request, entries, conference_form)
 
 
     @endpoints.method(SESSION_GET_REQUEST_BY_DATE, SessionForms,
@@ -1040,10 +2121,6 @@ class ConferenceApi(remote.Service):
         """Returns all sessions in a conference that is happening between
         a given date range
         """
-
-        (sessions, conference_form) = \
-                    self._get_sessions_in_conf(request.websafeConferenceKey)
-
         try:
             begin = datetime.strptime(request.startDate[:10], "%Y-%m-%d").date()
             end = datetime.strptime(request.endDate[:10], "%Y-%m-%d").date()
@@ -1055,23 +2132,81 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException(
                     "Start date should come before end date.")
 
-        # filter session query by property
-        sessions = sessions.filter(Session.date>=begin) \
-                    .filter(Session.date<=end)
+        entries, conference_form = \
+                    self._getSchedule(request.websafeConferenceKey)
+
+        # filter schedule by property
+        entries = [entry for entry in entries
+                    if entry['date'] is not None and
+                        begin <= entry['date'] <= end]
 
         # return sesions
-        return SessionForms(
-            items=[self._copySessionToForm(session, confForm=conference_form) \
-                    for session in sessions]
-        )
+        return self._scheduleForms(request, entries, conference_form)
+
+
+    def _getWishlistIndex(self, prof):
+        """Return the WishlistIndex of the profile, rebuilt from the wishlist
+        sessions if it is missing or out of date.
+        """
+        index = ndb.Key(WishlistIndex, WISHLIST_INDEX_ID,
+                        parent=prof.key).get()
+        if index and set(index.sessionKeys) == set(prof.sessionKeysWishList):
+            return index
+
+        wish_keys = list(set(prof.sessionKeysWishList))
+        sessions = ndb.get_multi([ndb.Key(urlsafe=wish_key)
+                                    for wish_key in wish_keys])
+        intervals = sorted(filter(None, [_sessionInterval(session)
+                                         for session in sessions if session]))
+        index = WishlistIndex(id=WISHLIST_INDEX_ID, parent=prof.key,
+                              sessionKeys=wish_keys,
+                              starts=[start for start, end in intervals],
+                              ends=[end for start, end in intervals],
+                              maxEnds=[])
+        for end in index.ends:
+            index.maxEnds.append(max(end, index.maxEnds[-1]) \
+                                    if index.maxEnds else end)
+        return index
+
+
+    @staticmethod
+    def _hasConflict(index, start, end):
+        """Return True if an interval of the WishlistIndex overlaps the
+        interval from start to end. O(log n): the intervals starting before
+        end overlap it iff the latest of their ends is after start.
+        """
+        i = bisect_left(index.starts, end)
+        return i > 0 and index.maxEnds[i - 1] > start
 
 
-    @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
+    @staticmethod
+    def _addToWishlistIndex(index, websafeSessionKey, interval):
+        """Add a session, with its interval (or None), to the
+        WishlistIndex. Finding where it goes is O(log n), but the insert
+        shifts the lists, and putting the index rewrites all of it, so
+        adding a session costs O(n)."""
+        index.sessionKeys.append(websafeSessionKey)
+        if not interval:
+            return
+        start, end = interval
+        i = bisect_right(index.starts, start)
+        index.starts.insert(i, start)
+        index.ends.insert(i, end)
+        # only the prefix maxima from i on change
+        del index.maxEnds[i:]
+        for end in index.ends[i:]:
+            index.maxEnds.append(max(end, index.maxEnds[-1]) \
+                                    if index.maxEnds else end)
+
+
+    @endpoints.method(WISHLIST_ADD_REQUEST, BooleanMessage,
         path='user/session/wishlist/add/{websafeSessionKey}',
         http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
         """Adds the session to the user's list of sessions they are interested
-        in attending"""
+        in attending. With checkConflicts, refuses sessions that overlap a
+        session already in the list.
+        """
         prof = self._getProfileFromUser() # get user Profile
 
         # get target session
@@ -1085,34 +2220,57 @@ class ConferenceApi(remote.Service):
         if s_key in prof.sessionKeysWishList:
             raise ConflictException("The session is already in your wishlist.")
 
+        index = self._getWishlistIndex(prof)
+        interval = _sessionInterval(session)
+        if request.checkConflicts and interval and \
+                self._hasConflict(index, *interval):
+            raise ConflictException(
+                "The session overlaps a session in your wishlist.")
+
         prof.sessionKeysWishList.append(s_key)
-        prof.put()
+        self._addToWishlistIndex(index, s_key, interval)
+        ndb.put_multi([prof, index])
 
         return BooleanMessage(data=True)
 
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(WISHLIST_GET_REQUEST, SessionForms,
         path='user/session/wishlist',
         http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
-        """Returns all the sessions the user is interested in attending"""
+        """Returns all the sessions the user is interested in attending.
+        With agenda, the sessions are sorted by date and start time, and
+        the groups of sessions whose times overlap are returned as conflicts.
+        """
         prof = self._getProfileFromUser() # get user Profile
 
         s_keys = [(ndb.Key(urlsafe=wish_key)) \
                         for wish_key in prof.sessionKeysWishList]
         sessions = ndb.get_multi(s_keys)
+        if not request.agenda:
+            # return sesions
+            return self._sessionForms(request, sessions)
 
-        # return sesions
-        return SessionForms(
-            items=[self._copySessionToForm(session) for session in sessions]
-        )
+        sessions = sorted((session for session in sessions if session),
+                          key=_agendaOrder)
+        intervals = []
+        for session in sessions:
+            interval = _sessionInterval(session)
+            if interval:
+                intervals.append(interval + (session.key.urlsafe(),))
+        return self._sessionForms(request, sessions,
+                                  conflicts=_conflictGroups(intervals))
 
 
-    @endpoints.method(message_types.VoidMessage, SessionForms,
+    @endpoints.method(SESSION_PAGE_REQUEST, SessionForms,
         path='multiinequalityplayground',
         http_method='GET', name='multiInequalityPlayground')
     def multiInequalityPlayground(self, request):
         """Multi-property inequality playground"""
+        if request.pageSize is not None and request.pageSize <= 0:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number.")
+
         # Multi inequality mixed with equality query:
         # sessions = MultiPropInequality(Session) \
         #     .filter(Session.duration<=90) \
@@ -1130,15 +2288,46 @@ class ConferenceApi(remote.Service):
         # sessions = MultiPropInequality(sessions) \
         #      .filter(Session.typeOfSession!='LECTURE')
 
-        # Query for all non-workshop before 7pm
-        sessions = MultiPropInequality(Session) \
+        # Query for the next non-workshop sessions before 7pm, by start time;
+        # post filters are evaluated on a projection so that filtered out
+        # sessions are not fetched
+        sessions = MultiPropInequality(Session, projection_prefilter=True) \
             .filter(Session.typeOfSession!='WORKSHOP') \
-            .filter(Session.startTime<datetime.strptime('19:00', '%H:%M').time())
+            .filter(Session.startTime<datetime.strptime('19:00', '%H:%M').time()) \
+            .order(Session.startTime)
 
-        return SessionForms(
-            items=[self._copySessionToForm(session) \
-                    for session in sessions]
-        )
+        # read only as many sessions as fit in one page
+        try:
+            start_cursor = MultiCursor(urlsafe=request.cursor) \
+                if request.cursor else None
+            sessions, cursor, more = sessions.fetch_page(
+                min(request.pageSize or MAX_PAGE_SIZE, MAX_PAGE_SIZE),
+                start_cursor=start_cursor)
+        except BadValueError:
+            raise endpoints.BadRequestException("Invalid cursor.")
+
+        return self._sessionForms(request, sessions,
+                                  nextCursor=cursor.urlsafe() if more else None)
+
+
+    @endpoints.method(message_types.VoidMessage, QueryStatsForms,
+        path='stats/queries',
+        http_method='GET', name='getQueryStats')
+    def getQueryStats(self, request):
+        """Returns, per kind, how many entities multi-property inequality
+        queries scanned and how many they returned.
+        """
+        items = []
+        for kind, (scanned, returned) in sorted(
+                stats.scan_counts(STATS_KINDS).items()):
+            items.append(QueryStatsForm(
+                kind=kind,
+                scanned=scanned,
+                returned=returned,
+                scannedPerReturned=float(scanned) / returned if returned
+                                        else None
+            ))
+        return QueryStatsForms(items=items)
 
 
 api = endpoints.api_server([ConferenceApi]) # register API
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""converters.py
+
+Copying of ndb entities to ProtoRPC messages.
+
+copier() generates, once per (model class, message class) pair, a function
+that copies exactly the message fields the model has, with each field's
+conversion resolved in advance, instead of inspecting every field of every
+entity with hasattr/getattr.
+
+"""
+
+# (model class, message class): copy function
+_copiers = {}
+
+
+def _build_copier(model_class, message_class, conversions, excluded):
+    """Generate the copy function of a (model class, message class) pair."""
+    namespace = {}
+    lines = []
+    for field in message_class.all_fields():
+        name = field.name
+        if name in excluded:
+            continue
+        if hasattr(model_class, name):
+            if name in conversions:
+                namespace['convert_' + name] = conversions[name]
+                lines.append('message.%s = convert_%s(entity.%s)'
+                             % (name, name, name))
+            else:
+                lines.append('message.%s = entity.%s' % (name, name))
+        elif name == 'websafeKey':
+            lines.append('message.websafeKey = entity.key.urlsafe()')
+
+    source = 'def copy(entity, message):\n%s\n' % (
+        '\n'.join('    ' + line for line in lines) or '    pass')
+    exec(compile(source, '<copy %s to %s>' % (model_class.__name__,
+                                             message_class.__name__),
+                 'exec'), namespace)
+    return namespace['copy']
+
+
+def copier(model_class, message_class, conversions=None, excluded=()):
+    """Return a function copy(entity, message) that sets the fields of
+    message from the same-named attributes of entity.
+
+    conversions maps field names to functions converting the attribute value
+    to the field value. A 'websafeKey' field the model has no attribute for
+    is set to the entity's websafe key. Fields in excluded, and fields the
+    model has no attribute for, are left unset.
+
+    The function is generated on the first call for a pair; later calls
+    return it, so a pair must always be given the same conversions.
+    """
+    pair = (model_class, message_class)
+    if pair not in _copiers:
+        _copiers[pair] = _build_copier(model_class, message_class,
+                                       conversions or {}, excluded)
+    return _copiers[pair]
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+"""converters_benchmark.py
+
+Microbenchmark of converters.copier: the copy function generated for a
+(model class, message class) pair, against the loop over all_fields() with
+hasattr/getattr/setattr that the form builders used before. Both copy plain
+stub objects shaped like a Session and a SessionForm, and are checked to
+produce the same fields first. Runs without the App Engine SDK:
+
+    python converters_benchmark.py
+
+"""
+
+from __future__ import print_function
+
+import functools
+import random
+import timeit
+from datetime import date
+from datetime import time
+
+from converters import copier
+
+ENTITIES = 10000
+REPEAT = 5
+
+
+class Field(object):
+    """Stub of a ProtoRPC message field."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+class SessionType(object):
+    """Stub of the SessionType enum."""
+    NOT_SPECIFIED = 'NOT_SPECIFIED'
+    LECTURE = 'LECTURE'
+    WORKSHOP = 'WORKSHOP'
+
+
+class SessionForm(object):
+    """Stub of the SessionForm message."""
+    FIELDS = [Field(name) for name in (
+        'name', 'highlights', 'speaker', 'duration', 'typeOfSession', 'date',
+        'startTime', 'websafeKey', 'websafeSpeakerKey', 'websafeConferenceKey',
+        'conferenceName', 'organizerDisplayName')]
+
+    @classmethod
+    def all_fields(cls):
+        return cls.FIELDS
+
+
+class Key(object):
+    """Stub of an ndb.Key."""
+
+    def __init__(self, urlsafe):
+        self._urlsafe = urlsafe
+
+    def urlsafe(self):
+        return self._urlsafe
+
+
+class Session(object):
+    """Stub of a Session entity; attributes of the model are class
+    attributes, as ndb properties are.
+    """
+    name = highlights = speaker = duration = typeOfSession = None
+    date = startTime = websafeSpeakerKey = websafeConferenceKey = None
+    conferenceName = organizerDisplayName = None
+
+    def __init__(self, rng, number):
+        self.key = Key('session-%d' % number)
+        self.name = 'Session %d' % number
+        self.highlights = rng.choice([None, 'Keynote', 'Hands on'])
+        self.speaker = 'Speaker %d' % rng.randint(1, 100)
+        self.duration = rng.choice([30, 45, 60, 90])
+        self.typeOfSession = rng.choice(['NOT_SPECIFIED', 'LECTURE',
+                                         'WORKSHOP'])
+        self.date = date(2026, rng.randint(1, 12), rng.randint(1, 28))
+        self.startTime = time(rng.randint(8, 18), rng.choice([0, 30]))
+        self.websafeSpeakerKey = 'speaker-%d' % rng.randint(1, 100)
+        self.websafeConferenceKey = 'conference-%d' % rng.randint(1, 10)
+        self.conferenceName = 'Conference'
+        self.organizerDisplayName = 'Organizer'
+
+
+def copy_fields(session, session_form):
+    """Copy session to session_form field by field, as the form builder did
+    before copier().
+    """
+    for field in session_form.all_fields():
+        if hasattr(session, field.name):
+            # convert date and time to string
+            if field.name in ('date', 'startTime'):
+                setattr(session_form, field.name,
+                        str(getattr(session, field.name)))
+            # convert typeOfSession to enum
+            elif field.name == 'typeOfSession':
+                setattr(session_form, field.name,
+                        getattr(SessionType, getattr(session, field.name)))
+            # just copy the rest
+            else:
+                setattr(session_form, field.name,
+                        getattr(session, field.name))
+        elif field.name == 'websafeKey':
+            setattr(session_form, field.name, session.key.urlsafe())
+
+
+def copy_all(copy, sessions):
+    """Copy each of sessions to a new SessionForm with copy."""
+    for session in sessions:
+        copy(session, SessionForm())
+
+
+def main():
+    rng = random.Random(1)
+    sessions = [Session(rng, number) for number in range(ENTITIES)]
+    generated = copier(Session, SessionForm, {
+        'date': str,
+        'startTime': str,
+        'typeOfSession': lambda value: getattr(SessionType, value)
+    })
+
+    for session in sessions[:100]:
+        copied, generated_form = SessionForm(), SessionForm()
+        copy_fields(session, copied)
+        generated(session, generated_form)
+        assert vars(copied) == vars(generated_form)
+
+    timings = []
+    for copy in (copy_fields, generated):
+        timings.append(min(timeit.repeat(
+            functools.partial(copy_all, copy, sessions),
+            number=1, repeat=REPEAT)) / ENTITIES * 1e6)
+    print('%d sessions, best of %d runs' % (ENTITIES, REPEAT))
+    print('hasattr/getattr %.2f us  copier %.2f us  x%.1f per session' % (
+        timings[0], timings[1], timings[0] / timings[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""export.py
+
+Bulk export of conferences, sessions, speakers, profiles and registrations.
+
+An export walks each kind in pages with query cursors, as a chain of tasks
+that each export one page, so no request runs into a deadline. Each page
+is written as an ExportChunk of compact NDJSON, one entity per line:
+
+    {"kind":"Session","key":"ag...","name":"Engines","duration":45,...}
+
+Properties are copied as stored; dates and times are ISO 8601 strings,
+keys are websafe keys, and unset properties are left out.
+
+The page's chunk, the cursor of the next page and the next task are
+committed in one transaction on the ExportJob, so an export that is
+killed resumes from the last page written, and every page is written
+exactly once.
+
+"""
+
+import json
+import uuid
+from datetime import date
+from datetime import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import Conference
+from models import ExportChunk
+from models import ExportJob
+from models import Profile
+from models import Registration
+from models import Session
+from models import Speaker
+
+PAGE_SIZE = 500             # entities per chunk
+READ_BATCH_SIZE = 20        # chunks read at once when downloading
+
+EXPORTED = (Conference, Session, Speaker, Profile, Registration)
+KINDS = dict((model_class._get_kind(), model_class)
+             for model_class in EXPORTED)
+EXPORT_KINDS = [model_class._get_kind() for model_class in EXPORTED]
+
+
+def _json_value(value):
+    """Return a property value as a JSON value."""
+    if isinstance(value, list):
+        return [_json_value(item) for item in value]
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, ndb.Key):
+        return value.urlsafe()
+    return value
+
+
+def _ndjson(entity):
+    """Return an entity as a line of compact NDJSON."""
+    row = {'kind': entity.key.kind(), 'key': entity.key.urlsafe()}
+    for name, value in entity.to_dict().items():
+        if value is not None and value != []:
+            row[name] = _json_value(value)
+    return json.dumps(row, separators=(',', ':')) + '\n'
+
+
+def start(kinds=None):
+    """Start exporting kinds (default: EXPORT_KINDS). Returns the ExportJob.
+    """
+    job = ExportJob(id=uuid.uuid4().hex, kinds=kinds or EXPORT_KINDS)
+
+    @ndb.transactional()
+    def put():
+        job.put()
+        taskqueue.add(params={'job': job.key.id()}, url='/tasks/export',
+                      transactional=True)
+    put()
+    return job
+
+
+def export_page(job_id):
+    """Export the next page of ExportJob job_id and chain a task for the
+    page after it. Used by the export task.
+    """
+    job = ExportJob.get_by_id(job_id)
+    if not job or job.done:
+        return
+    model_class = KINDS[job.kinds[job.kindIndex]]
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    entities, cursor, more = model_class.query().fetch_page(
+        PAGE_SIZE, start_cursor=cursor)
+    data = ''.join(_ndjson(entity) for entity in entities)
+
+    @ndb.transactional()
+    def checkpoint():
+        current = job.key.get()
+        if (current.kindIndex, current.cursor) != (job.kindIndex, job.cursor):
+            # a retried task already wrote the page
+            return
+        if entities:
+            current.chunks += 1
+            ExportChunk(parent=job.key, id=current.chunks,
+                        kind=model_class._get_kind(), count=len(entities),
+                        data=data).put()
+            current.entities += len(entities)
+        if more and cursor:
+            current.cursor = cursor.urlsafe()
+        else:
+            current.kindIndex += 1
+            current.cursor = None
+        current.done = current.kindIndex >= len(current.kinds)
+        current.put()
+        if not current.done:
+            taskqueue.add(params={'job': job_id}, url='/tasks/export',
+                          transactional=True)
+    checkpoint()
+
+
+def chunks(job):
+    """Yield the NDJSON chunks of an ExportJob, in order."""
+    for first in range(1, job.chunks + 1, READ_BATCH_SIZE):
+        keys = [ndb.Key(ExportChunk, i, parent=job.key)
+                for i in range(first, min(first + READ_BATCH_SIZE,
+                                          job.chunks + 1))]
+        for chunk in ndb.get_multi(keys):
+            yield chunk.data
+
+
+def report(job):
+    """Return the progress of an ExportJob as a dict."""
+    return {
+        'job': job.key.id(),
+        'done': job.done,
+        'kinds': job.kinds,
+        'kind': None if job.done else job.kinds[job.kindIndex],
+        'chunks': job.chunks,
+        'entities': job.entities,
+    }
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""fieldmask.py
+
+Partial responses. A field mask, in the syntax of Google partial responses,
+selects the fields of a response message to return, e.g.
+
+    items(name,startTime,speaker/name),nextCursor
+
+selects the name, start time and speaker name of each item and the cursor.
+'a/b' selects field b of a, 'a(b,c)' fields b and c of a, and '*' all
+fields. A parsed mask is a dict {field name: mask of its subfields}, where
+None selects the whole field.
+
+"""
+
+import re
+
+from protorpc import messages
+
+_TOKENS = re.compile(r'\s*([^,/()\s]+|[,/()])')
+
+
+def parse(mask):
+    """Parse a field mask. Returns None (everything) for an empty mask.
+    Raises ValueError if the mask is malformed.
+    """
+    if not mask or not mask.strip():
+        return None
+    tokens = _TOKENS.findall(mask)
+    parsed, pos = _parse_list(tokens, 0)
+    if pos != len(tokens):
+        raise ValueError('Invalid field mask: %s' % mask)
+    return parsed
+
+
+def _parse_list(tokens, pos):
+    """Parse comma separated items from tokens[pos]. Returns (mask, position
+    after the items).
+    """
+    mask = {}
+    while True:
+        pos = _parse_item(tokens, pos, mask)
+        if pos < len(tokens) and tokens[pos] == ',':
+            pos += 1
+        else:
+            return mask, pos
+
+
+def _parse_item(tokens, pos, mask):
+    """Parse a 'a/b(c,d)' item from tokens[pos] into mask. Returns the
+    position after the item.
+    """
+    names = [_name(tokens, pos)]
+    pos += 1
+    while pos < len(tokens) and tokens[pos] == '/':
+        names.append(_name(tokens, pos + 1))
+        pos += 2
+
+    submask = None
+    if pos < len(tokens) and tokens[pos] == '(':
+        submask, pos = _parse_list(tokens, pos + 1)
+        if pos >= len(tokens) or tokens[pos] != ')':
+            raise ValueError('Unbalanced parentheses in field mask.')
+        pos += 1
+
+    for name in reversed(names[1:]):
+        submask = {name: submask}
+    _merge(mask, names[0], submask)
+    return pos
+
+
+def _name(tokens, pos):
+    """Return the field name at tokens[pos]."""
+    if pos >= len(tokens) or tokens[pos] in (',', '/', '(', ')'):
+        raise ValueError('Field name expected in field mask.')
+    return tokens[pos]
+
+
+def _merge(mask, name, submask):
+    """Add field name, with submask, to mask."""
+    if name not in mask:
+        mask[name] = submask
+    elif mask[name] is None or submask is None:
+        mask[name] = None
+    else:
+        for subname, subsubmask in submask.items():
+            _merge(mask[name], subname, subsubmask)
+
+
+def selects(mask, name):
+    """Return True if mask selects field name (or some of its subfields)."""
+    return mask is None or name in mask or '*' in mask
+
+
+def submask(mask, name):
+    """Return the mask of the subfields of field name."""
+    if mask is None or name not in mask:
+        return None
+    return mask[name]
+
+
+def prune(message, mask):
+    """Clear the fields of message that mask does not select, recursively.
+    Returns message. Raises ValueError if mask names unknown fields.
+    """
+    if mask is None:
+        return message
+    fields = message.all_fields()
+    unknown = set(mask) - set(field.name for field in fields) - set(['*'])
+    if unknown:
+        raise ValueError('Unknown fields in field mask: %s'
+                         % ', '.join(sorted(unknown)))
+
+    for field in fields:
+        if not selects(mask, field.name):
+            message.reset(field.name)
+            continue
+        fieldmask = submask(mask, field.name)
+        if fieldmask is None:
+            continue
+        if not isinstance(field, messages.MessageField):
+            raise ValueError('Field %s has no subfields.' % field.name)
+        value = getattr(message, field.name)
+        for item in (value if field.repeated else [value]):
+            if item is not None:
+                prune(item, fieldmask)
+    return message
@@ -12,10 +12,19 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
 from conference import ConferenceApi
+from models import Conference
+from models import ExportJob
+from models import Session
+import bulk
+import export
+import stats
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
@@ -24,6 +33,21 @@ class SetAnnouncementHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class BuildStatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start sampling entities for selectivity statistics."""
+        stats.start([model_class._get_kind()
+                     for model_class in (Conference, Session)])
+        self.response.set_status(204)
+
+
+class SampleStatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Sample a page of keys of a kind, building its statistics after
+        the last page."""
+        stats.sample_page(self.request.get('kind'))
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
         """Send email confirming Conference creation."""
@@ -47,8 +71,136 @@ class CheckSpeakerHandler(webapp2.RequestHandler):
             self.request.get('websafeConferenceKey')
         )
 
+class RebuildScheduleHandler(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the schedule of a conference, or of all conferences a
+        speaker has sessions in.
+        """
+        if self.request.get('websafeConferenceKey'):
+            ConferenceApi._rebuildSchedule(
+                self.request.get('websafeConferenceKey')
+            )
+        else:
+            ConferenceApi._rebuildSpeakerSchedules(
+                self.request.get('websafeSpeakerKey')
+            )
+
+class ReconcileSeatsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy free seats from the seat shards to the Conference."""
+        ConferenceApi._reconcileSeats(
+            self.request.get('websafeConferenceKey')
+        )
+
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy organizer's display name to the conferences they organize."""
+        ConferenceApi._updateOrganizerDisplayName(
+            self.request.get('userId'),
+            self.request.get('cursor') or None
+        )
+
+
+class InvalidateConferenceQueriesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Invalidate cached conference query results once recent writes
+        show up in queries."""
+        ConferenceApi._invalidateConferenceQueries()
+
+
+class BackfillOrganizerNamesHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start backfilling organizerDisplayName on existing conferences."""
+        taskqueue.add(url='/tasks/backfill_organizer_names')
+        self.response.set_status(202)
+
+    def post(self):
+        """Backfill organizerDisplayName on a page of conferences."""
+        ConferenceApi._backfillOrganizerDisplayNames(
+            self.request.get('cursor') or None
+        )
+
+class MigrateRegistrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving Profile registration lists to Registration entities."""
+        taskqueue.add(url='/tasks/migrate_registrations')
+        self.response.set_status(202)
+
+    def post(self):
+        """Move registrations of a page of profiles."""
+        ConferenceApi._migrateRegistrations(
+            self.request.get('cursor') or None
+        )
+
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import conferences, speakers and sessions from the NDJSON (or,
+        with Content-Type text/csv, CSV) request body as import job `job`,
+        resuming the job if it exists.
+        """
+        if self.request.content_type == 'text/csv':
+            rows = bulk.csv_rows(self.request.body_file)
+        else:
+            rows = bulk.ndjson_rows(self.request.body_file)
+        try:
+            job = bulk.run(self.request.GET.get('job'), rows)
+        except ValueError as e:
+            self.abort(400, detail=str(e))
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(bulk.report(job)))
+
+class ExportHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start exporting conferences, sessions, speakers, profiles and
+        registrations; returns the job id."""
+        job = export.start()
+        self.response.set_status(202)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(export.report(job)))
+
+    def post(self):
+        """Export the next page of an export job."""
+        export.export_page(self.request.get('job'))
+
+
+class ExportStatusHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the progress of export job `job`."""
+        job = ExportJob.get_by_id(self.request.get('job'))
+        if not job:
+            self.abort(404)
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps(export.report(job)))
+
+
+class ExportDownloadHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the NDJSON of finished export job `job`."""
+        job = ExportJob.get_by_id(self.request.get('job'))
+        if not job:
+            self.abort(404)
+        if not job.done:
+            self.abort(409, detail='The export is not done yet.')
+        self.response.content_type = 'application/x-ndjson'
+        for data in export.chunks(job):
+            self.response.write(data)
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/build_stats', BuildStatsHandler),
+    ('/tasks/sample_stats', SampleStatsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/check_speaker', CheckSpeakerHandler)
+    ('/tasks/check_speaker', CheckSpeakerHandler),
+    ('/tasks/rebuild_schedule', RebuildScheduleHandler),
+    ('/tasks/reconcile_seats', ReconcileSeatsHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/invalidate_conference_queries',
+        InvalidateConferenceQueriesHandler),
+    ('/tasks/backfill_organizer_names', BackfillOrganizerNamesHandler),
+    ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+    ('/tasks/export', ExportHandler),
+    ('/admin/import', ImportHandler),
+    ('/admin/export/status', ExportStatusHandler),
+    ('/admin/export/download', ExportDownloadHandler)
 ], debug=True)
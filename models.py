@@ -21,14 +21,40 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class ServiceUnavailableException(endpoints.ServiceException):
+    """ServiceUnavailableException -- exception mapped to HTTP 503 response"""
+    http_status = httplib.SERVICE_UNAVAILABLE
+
+class NotModifiedException(endpoints.ServiceException):
+    """NotModifiedException -- exception mapped to HTTP 304 response"""
+    http_status = httplib.NOT_MODIFIED
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
+    # ndb caches Profiles in memcache (invalidated on put); keep them briefly
+    _memcache_timeout = 60
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionKeysWishList = ndb.StringProperty(repeated=True)
 
+class Registration(ndb.Model):
+    """Registration -- a Profile's registration for a Conference; child of
+    the Profile, with the websafe conference key as id"""
+    conference = ndb.KeyProperty(kind='Conference')
+    seatShard = ndb.StringProperty(indexed=False) # id of the SeatShard
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+class WishlistIndex(ndb.Model):
+    """WishlistIndex -- time intervals of the sessions in a Profile's
+    wishlist, sorted by start, for conflict checks; child of the Profile,
+    id 'wishlist'"""
+    sessionKeys = ndb.StringProperty(repeated=True, indexed=False) # sessions covered
+    starts = ndb.PickleProperty()   # sorted start datetimes
+    ends = ndb.PickleProperty()     # end datetimes, in the order of starts
+    maxEnds = ndb.PickleProperty()  # maxEnds[i] = max(ends[:i + 1])
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -41,9 +67,15 @@ class ProfileForm(messages.Message):
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
 
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    etag = messages.StringField(2)
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -54,6 +86,7 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    organizerDisplayName = ndb.StringProperty(indexed=False) # denormalized from Profile
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -62,6 +95,70 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
 
+class SeatShard(ndb.Model):
+    """SeatShard -- one shard of a conference's sharded seat counter"""
+    capacity = ndb.IntegerProperty(indexed=False, default=0)
+    reserved = ndb.IntegerProperty(indexed=False, default=0)
+
+class PropertyStats(ndb.Model):
+    """PropertyStats -- sampled value distribution of a property, used to
+    estimate filter selectivity; id is '<kind>.<property>'"""
+    kind = ndb.StringProperty()
+    name = ndb.StringProperty(indexed=False)
+    total = ndb.IntegerProperty(indexed=False)      # entities of kind
+    sampled = ndb.IntegerProperty(indexed=False)    # entities sampled
+    nulls = ndb.FloatProperty(indexed=False)        # fraction without value
+    distinct = ndb.IntegerProperty(indexed=False)   # distinct values sampled
+    bounds = ndb.PickleProperty()                   # histogram bucket bounds
+    frequent = ndb.PickleProperty()                 # {value: fraction}
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class StatsSample(ndb.Model):
+    """StatsSample -- checkpoint of sampling a kind for statistics (see
+    stats.py); id is the kind"""
+    cursor = ndb.StringProperty(indexed=False)  # of the next page of keys
+    seen = ndb.IntegerProperty(default=0, indexed=False) # keys read
+    keys = ndb.PickleProperty(compressed=True) # sampled websafe keys
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+class AlmostSoldOut(ndb.Model):
+    """AlmostSoldOut -- the conferences in the announcement, those with few
+    seats left; a single entity, id 'announcement'"""
+    conferences = ndb.PickleProperty()  # {websafe key: name}
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ImportJob(ndb.Model):
+    """ImportJob -- checkpoint of a bulk import (see bulk.py); id is the job
+    id"""
+    rowsDone = ndb.IntegerProperty(default=0, indexed=False) # rows processed
+    pending = ndb.PickleProperty()  # {row: websafe key} of the batch in flight
+    refs = ndb.PickleProperty(compressed=True) # {ref: websafe key}
+    entities = ndb.IntegerProperty(default=0, indexed=False) # rows imported
+    rejected = ndb.IntegerProperty(default=0, indexed=False)
+    errors = ndb.StringProperty(repeated=True, indexed=False) # first errors
+    seconds = ndb.FloatProperty(default=0.0, indexed=False) # time importing
+    done = ndb.BooleanProperty(default=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ExportJob(ndb.Model):
+    """ExportJob -- checkpoint of a bulk export (see export.py); id is the job
+    id"""
+    kinds = ndb.StringProperty(repeated=True, indexed=False) # kinds to export
+    kindIndex = ndb.IntegerProperty(default=0, indexed=False) # kind exporting
+    cursor = ndb.StringProperty(indexed=False)  # next page of the kind
+    chunks = ndb.IntegerProperty(default=0, indexed=False) # chunks written
+    entities = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False)
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ExportChunk(ndb.Model):
+    """ExportChunk -- NDJSON of a page of exported entities; child of the
+    ExportJob, numbered from 1"""
+    kind = ndb.StringProperty(indexed=False)
+    count = ndb.IntegerProperty(indexed=False)
+    data = ndb.BlobProperty(compressed=True)
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -76,10 +173,13 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    queryPlan = messages.StringField(3)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -108,12 +208,17 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    cursor = messages.StringField(3)
+    debug = messages.BooleanField(4)
+    fieldMask = messages.StringField(5)
 
 class Speaker(ndb.Model):
     """Speaker -- User profile object"""
     name = ndb.StringProperty(required=True)
     bio = ndb.TextProperty()
     url = ndb.StringProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
 
 class SpeakerForm(messages.Message):
     """SpeakerForm -- Speaker form message"""
@@ -125,6 +230,7 @@ class SpeakerForm(messages.Message):
 class SpeakerForms(messages.Message):
     """SpeakerForms -- multiple Speakers outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    etag = messages.StringField(2)
 
 class SessionType(messages.Enum):
      """SessionType -- type of session enumeration value"""
@@ -151,6 +257,29 @@ class Session(ndb.Model):
     date                = ndb.DateProperty()
     startTime           = ndb.TimeProperty()
 
+class ConferenceSchedule(ndb.Model):
+    """ConferenceSchedule -- the sessions of a conference, sorted by date and
+    startTime, with their speakers; child of the Conference, id 'schedule'.
+    Each entry is a dict of the filterable session fields and 'form', the
+    JSON encoded SessionForm (without conference). Entries that do not fit
+    in one entity continue in ScheduleChunks"""
+    sessions = ndb.PickleProperty(compressed=True)
+    chunkIds = ndb.StringProperty(repeated=True, indexed=False) # in order
+    speakers = ndb.PickleProperty() # {websafe speaker key: Speaker.updated}
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+class ScheduleChunk(ndb.Model):
+    """ScheduleChunk -- more entries of a ConferenceSchedule; child of the
+    ConferenceSchedule"""
+    sessions = ndb.PickleProperty(compressed=True)
+
+class SpeakerSessionCount(ndb.Model):
+    """SpeakerSessionCount -- the sessions of a speaker in a conference;
+    child of the Conference, with the websafe speaker key as id"""
+    sessionKeys = ndb.StringProperty(repeated=True, indexed=False)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
 class SessionForm(messages.Message):
     """SessionForm -- Session outbound form message"""
     name            = messages.StringField(1)
@@ -166,6 +295,15 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    etag = messages.StringField(3)
+    conflicts = messages.MessageField('SessionConflictForm', 4, repeated=True)
+
+class SessionConflictForm(messages.Message):
+    """SessionConflictForm -- sessions whose times overlap"""
+    websafeSessionKeys = messages.StringField(1, repeated=True)
+    start = messages.StringField(2) #DateTimeField()
+    end = messages.StringField(3) #DateTimeField()
 
 class SessionEditForm(messages.Message):
     """SessionEditForm -- Session inbound form message"""
@@ -176,3 +314,14 @@ class SessionEditForm(messages.Message):
     duration          = messages.IntegerField(5) # In minutes
     date              = messages.StringField(6) #DateTimeField()
     startTime         = messages.StringField(7) #DateTimeField()
+
+class QueryStatsForm(messages.Message):
+    """QueryStatsForm -- entities scanned vs. returned by queries of a kind"""
+    kind                = messages.StringField(1)
+    scanned             = messages.IntegerField(2)
+    returned            = messages.IntegerField(3)
+    scannedPerReturned  = messages.FloatField(4)
+
+class QueryStatsForms(messages.Message):
+    """QueryStatsForms -- multiple QueryStatsForm outbound form message"""
+    items = messages.MessageField(QueryStatsForm, 1, repeated=True)
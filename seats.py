@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counter for conference registration.
+
+A conference's seats are split across SEAT_SHARDS SeatShard entities, each a
+root entity (and so its own entity group) holding a fixed `capacity` and the
+number of seats `reserved` from it. A registration reserves a seat from one
+randomly chosen shard with free seats, so concurrent registrations for the
+same conference rarely touch the same entity group, and no shard ever
+reserves more than its capacity, so maxAttendees is never oversold.
+
+The total is copied back to Conference.seatsAvailable by reconciliation.
+
+"""
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+SEAT_SHARDS = 20
+
+
+def shard_keys(conf_key):
+    """Return the keys of all seat shards of a conference."""
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+            for i in range(SEAT_SHARDS)]
+
+
+def _split(seats):
+    """Split seats into SEAT_SHARDS capacities that add up to seats."""
+    seats = max(seats or 0, 0)
+    share, rest = divmod(seats, SEAT_SHARDS)
+    return [share + (1 if i < rest else 0) for i in range(SEAT_SHARDS)]
+
+
+def new_shards(conf_key, seats):
+    """Return (unsaved) shards holding seats for a new conference."""
+    return [SeatShard(key=key, capacity=capacity)
+            for key, capacity in zip(shard_keys(conf_key), _split(seats))]
+
+
+def get_shards(conf):
+    """Return all seat shards of a conference.
+
+    Conferences created before seats were sharded get their shards created
+    from their current seatsAvailable.
+    """
+    keys = shard_keys(conf.key)
+    shards = ndb.get_multi(keys)
+    if None in shards:
+        capacities = _split(conf.seatsAvailable)
+        for i, shard in enumerate(shards):
+            if shard is None:
+                shards[i] = SeatShard.get_or_insert(
+                    keys[i].id(), capacity=capacities[i])
+    return shards
+
+
+def available(shards):
+    """Return the number of free seats in shards."""
+    return sum(max(shard.capacity - shard.reserved, 0) for shard in shards)
+
+
+def open_shard_keys(conf):
+    """Return, in random order, keys of the shards that have free seats."""
+    keys = [shard.key for shard in get_shards(conf)
+                if shard.reserved < shard.capacity]
+    random.shuffle(keys)
+    return keys
+
+
+def resize(shards, delta):
+    """Add delta (which may be negative) seats to the capacity of shards;
+    call within a transaction and put the shards afterwards. Seats are
+    added evenly and removed from each shard down to its reserved seats.
+    Raises ValueError, leaving shards unchanged, if more seats are reserved
+    than would be left.
+    """
+    if delta >= 0:
+        for shard, capacity in zip(shards, _split(delta)):
+            shard.capacity += capacity
+        return
+    removed = -delta
+    if available(shards) < removed:
+        raise ValueError('%d seats are reserved or taken already.'
+                         % (sum(shard.capacity for shard in shards)
+                            - available(shards)))
+    for shard in shards:
+        free = max(shard.capacity - shard.reserved, 0)
+        shard.capacity -= min(free, removed)
+        removed -= min(free, removed)
+
+
+def random_shard_key(conf_key):
+    """Return the key of a randomly chosen shard."""
+    return random.choice(shard_keys(conf_key))
+
+
+def release_shard_key(conf_key, registration):
+    """Return the key of the shard to give the seat of a registration back
+    to: the one it was taken from, or a random one for registrations that
+    did not record it.
+    """
+    if registration and registration.seatShard:
+        return ndb.Key(SeatShard, registration.seatShard)
+    return random_shard_key(conf_key)
+
+
+def take(shard):
+    """Reserve a seat from shard; call within a transaction and put the shard
+    afterwards. Returns False if the shard is full.
+    """
+    if shard.reserved >= shard.capacity:
+        return False
+    shard.reserved += 1
+    return True
+
+
+def give(shard):
+    """Return a seat to shard; call within a transaction and put the shard
+    afterwards. Seats taken before the conference was sharded are already
+    excluded from capacity, so they are given back as capacity.
+    """
+    if shard.reserved > 0:
+        shard.reserved -= 1
+    else:
+        shard.capacity += 1
@@ -16,3 +16,7 @@ WEB_CLIENT_ID = '757224007118-0lblpo8abqeantp8mvckmabupik9edk4.apps.googleuserco
 ANDROID_CLIENT_ID = '757224007118-dpqfa375ra8rgbpslig7beh4jb6qd03s.apps.googleusercontent.com'
 IOS_CLIENT_ID = '757224007118-nfgr65ic7dpiv5inbvta8a2b4j2h7d09.apps.googleusercontent.com'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Seconds a ConferenceForm may be served from an instance's local cache after
+# the conference changed (e.g. seatsAvailable after a registration).
+CONFERENCE_CACHE_STALENESS = 5
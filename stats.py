@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""stats.py
+
+Selectivity statistics for query planning.
+
+A daily cron starts, for each kind, a chain of tasks that read its keys a
+page at a time and keep a uniform random sample of them (reservoir
+sampling), checkpointed in a StatsSample entity. After the last page the
+sampled entities are read and, per property, an equi-depth histogram of
+their values and the frequencies of the most common values are stored
+(PropertyStats entities, cached in memcache). Values of repeated properties
+count once per entity. estimate() uses
+them to guess the fraction of entities matched by a filter, which lets
+MultiPropInequality run the most selective inequality in the datastore.
+
+Counters of entities scanned vs. returned by MultiPropInequality are kept in
+memcache to show how much post filtering costs.
+
+"""
+
+import random
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date
+from datetime import datetime
+from datetime import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from models import PropertyStats
+from models import StatsSample
+
+SAMPLE_SIZE = 1000          # entities sampled per kind
+KEYS_PER_TASK = 5000        # keys read per sampling task
+HISTOGRAM_BUCKETS = 20
+FREQUENT_VALUES = 20
+MEMCACHE_STATS_KEY_TPL = 'PROPERTY_STATS:%s'
+MEMCACHE_SCANNED_KEY_TPL = 'QUERY_SCANNED:%s'
+MEMCACHE_RETURNED_KEY_TPL = 'QUERY_RETURNED:%s'
+STATS_CACHE_TTL = 3600      # seconds
+
+# property types whose values can be ordered and compared
+_SAMPLED_TYPES = (ndb.IntegerProperty, ndb.FloatProperty, ndb.StringProperty,
+                  ndb.DateProperty, ndb.TimeProperty, ndb.DateTimeProperty,
+                  ndb.BooleanProperty)
+
+
+def _sampled_properties(model_class):
+    """Return the indexed, comparable properties of model_class."""
+    return [prop for prop in model_class._properties.values()
+                if isinstance(prop, _SAMPLED_TYPES) and prop._indexed]
+
+
+def start(kinds):
+    """Start sampling kinds for statistics, replacing samplings that are
+    still running."""
+    for kind in kinds:
+        _start(kind)
+
+
+def _start(kind):
+    """Start sampling kind with a new StatsSample and its first task."""
+    @ndb.transactional()
+    def put():
+        StatsSample(id=kind, keys=[]).put()
+        taskqueue.add(params={'kind': kind}, url='/tasks/sample_stats',
+                      transactional=True)
+    put()
+
+
+def sample_page(kind):
+    """Add the next page of keys of kind to its sample and chain a task for
+    the page after it; after the last page, build the statistics. Used by
+    the sample_stats task.
+    """
+    job = StatsSample.get_by_id(kind)
+    if not job or job.done:
+        return
+    model_class = ndb.Model._kind_map[kind]
+    cursor = Cursor(urlsafe=job.cursor) if job.cursor else None
+    keys, cursor, more = model_class.query().fetch_page(
+        KEYS_PER_TASK, start_cursor=cursor, keys_only=True)
+    more = bool(more and cursor)
+
+    # reservoir sampling: after n keys, each is in the sample with
+    # probability SAMPLE_SIZE / n
+    sample = list(job.keys or [])
+    seen = job.seen
+    for key in keys:
+        seen += 1
+        if len(sample) < SAMPLE_SIZE:
+            sample.append(key.urlsafe())
+        else:
+            i = random.randrange(seen)
+            if i < SAMPLE_SIZE:
+                sample[i] = key.urlsafe()
+    if not more:
+        build_stats(model_class, seen,
+                    [ndb.Key(urlsafe=websafe_key) for websafe_key in sample])
+
+    @ndb.transactional()
+    def checkpoint():
+        current = job.key.get()
+        if current.done or \
+                (current.cursor, current.seen) != (job.cursor, job.seen):
+            # a retried task already read the page
+            return
+        current.cursor = cursor.urlsafe() if more else None
+        current.seen = seen
+        current.keys = sample
+        current.done = not more
+        current.put()
+        if more:
+            taskqueue.add(params={'kind': kind}, url='/tasks/sample_stats',
+                          transactional=True)
+    checkpoint()
+
+
+def build_stats(model_class, total, keys):
+    """Store PropertyStats for each of the comparable properties of
+    model_class, of which there are total entities, from the entities of
+    keys, a sample of them.
+    """
+    kind = model_class._get_kind()
+    sample = [entity for entity in ndb.get_multi(keys) if entity]
+
+    stats = []
+    for prop in _sampled_properties(model_class):
+        values = []
+        nulls = 0
+        for entity in sample:
+            value = getattr(entity, prop._code_name)
+            if prop._repeated:
+                # each entity counts once per value it has
+                values.extend(set(value))
+                nulls += 0 if value else 1
+            elif value is None:
+                nulls += 1
+            else:
+                values.append(value)
+        values.sort()
+
+        counts = defaultdict(int)
+        for value in values:
+            counts[value] += 1
+        frequent = sorted(counts.items(), key=lambda item: -item[1])
+        frequent = frequent[:FREQUENT_VALUES]
+
+        # bucket boundaries of an equi-depth histogram
+        bounds = []
+        if values:
+            step = (len(values) - 1) / float(HISTOGRAM_BUCKETS)
+            bounds = [values[int(round(i * step))]
+                        for i in range(HISTOGRAM_BUCKETS + 1)]
+
+        sampled = len(sample) or 1
+        stats.append(PropertyStats(
+            id='%s.%s' % (kind, prop._name),
+            kind=kind,
+            name=prop._name,
+            total=total,
+            sampled=len(sample),
+            nulls=nulls / float(sampled),
+            distinct=len(counts),
+            bounds=bounds,
+            frequent=dict((value, count / float(sampled))
+                            for value, count in frequent)
+        ))
+
+    ndb.put_multi(stats)
+    memcache.set(MEMCACHE_STATS_KEY_TPL % kind,
+                 dict((s.name, s) for s in stats), time=STATS_CACHE_TTL)
+
+
+def get_stats(kind):
+    """Return {property name: PropertyStats} for kind; empty if the kind has
+    not been sampled yet.
+    """
+    stats = memcache.get(MEMCACHE_STATS_KEY_TPL % kind)
+    if stats is None:
+        stats = dict((s.name, s) for s in
+                        PropertyStats.query(PropertyStats.kind == kind))
+        memcache.set(MEMCACHE_STATS_KEY_TPL % kind, stats,
+                     time=STATS_CACHE_TTL)
+    return stats
+
+
+def _coerce(bounds, value):
+    """Filters on DateProperty and TimeProperty hold datetimes; convert value
+    to the type of the sampled values.
+    """
+    if bounds and isinstance(value, datetime):
+        if isinstance(bounds[0], time):
+            return value.time()
+        if not isinstance(bounds[0], datetime) and \
+                isinstance(bounds[0], date):
+            return value.date()
+    return value
+
+
+def estimate(kind, name, symbol, value):
+    """Return the estimated fraction of kind entities for which
+    `name symbol value` is true, or None if the property has no statistics.
+    """
+    prop_stats = get_stats(kind).get(name)
+    if not prop_stats or not prop_stats.sampled:
+        return None
+
+    bounds = prop_stats.bounds
+    value = _coerce(bounds, value)
+    non_null = 1.0 - prop_stats.nulls
+
+    def equal():
+        if value in prop_stats.frequent:
+            return prop_stats.frequent[value]
+        rest = non_null - sum(prop_stats.frequent.values())
+        others = prop_stats.distinct - len(prop_stats.frequent)
+        return max(rest, 0.0) / others if others > 0 else 0.0
+
+    def below(inclusive):
+        if not bounds:
+            return 0.0
+        try:
+            position = (bisect_right if inclusive else bisect_left)(
+                bounds, value)
+        except TypeError:
+            return None
+        return non_null * position / float(len(bounds))
+
+    if symbol == '=':
+        return equal()
+    if symbol == '!=':
+        return max(non_null - equal(), 0.0)
+    if symbol in ('<', '<='):
+        return below(symbol == '<=')
+    if symbol in ('>', '>='):
+        fraction = below(symbol == '>')
+        return None if fraction is None else max(non_null - fraction, 0.0)
+    return None
+
+
+def record_scan(kind, scanned, returned):
+    """Add to the counters of entities scanned and returned for kind."""
+    memcache.offset_multi({
+        MEMCACHE_SCANNED_KEY_TPL % kind: scanned,
+        MEMCACHE_RETURNED_KEY_TPL % kind: returned,
+    }, initial_value=0)
+
+
+def scan_counts(kinds):
+    """Return {kind: (scanned, returned)} recorded by record_scan()."""
+    keys = []
+    for kind in kinds:
+        keys.extend([MEMCACHE_SCANNED_KEY_TPL % kind,
+                     MEMCACHE_RETURNED_KEY_TPL % kind])
+    counts = memcache.get_multi(keys)
+    return dict((kind, (counts.get(MEMCACHE_SCANNED_KEY_TPL % kind, 0),
+                        counts.get(MEMCACHE_RETURNED_KEY_TPL % kind, 0)))
+                for kind in kinds)
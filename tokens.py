@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+"""tokens.py
+
+OAuth identity of bearer tokens, for utils.getUserId().
+
+Google ID tokens are JWTs signed with Google's public keys. They are verified
+locally: the signature is checked with the published signing keys (cached per
+instance and in memcache), then the issuer, audience and expiry. Other tokens
+(access tokens) are looked up with the tokeninfo endpoint.
+
+Either way, the user id is cached per instance and in memcache, keyed on a
+hash of the token, until the token expires.
+
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import re
+import time
+
+import endpoints
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from cache import LRUCache
+from models import ServiceUnavailableException
+from settings import ANDROID_CLIENT_ID
+from settings import IOS_CLIENT_ID
+from settings import WEB_CLIENT_ID
+
+CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+AUDIENCES = (WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID,
+             endpoints.API_EXPLORER_CLIENT_ID)
+CLOCK_SKEW = 300            # seconds allowed between token and server clocks
+CERTS_CACHE_TTL = 3600      # seconds, if the key server gives no max-age
+TOKENINFO_ATTEMPTS = 2
+MEMCACHE_TOKEN_KEY_TPL = 'TOKEN_USER:%s'
+MEMCACHE_CERTS_KEY = 'GOOGLE_SIGNING_KEYS'
+
+# token hash: (expiry time, user id)
+_identities = LRUCache(max_size=1000, ttl=3600)
+# signing keys: (expiry time, {key id: RSA key})
+_signing_keys = {}
+
+
+class InvalidTokenError(Exception):
+    """The token is not a valid ID token."""
+
+
+def _b64decode(segment):
+    """Decode a base64url segment of a JWT, which has no padding."""
+    segment = str(segment)
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _to_int(segment):
+    """Decode a base64url encoded big-endian unsigned integer."""
+    return int(binascii.hexlify(_b64decode(segment)), 16)
+
+
+def _fetch_signing_keys():
+    """Fetch Google's signing keys. Returns (expiry time, JWKS keys).
+    Raises ServiceUnavailableException if the key server is unreachable.
+    """
+    try:
+        resp = urlfetch.fetch(CERTS_URL)
+    except urlfetch.DownloadError:
+        raise ServiceUnavailableException(
+            'Cannot verify tokens now; signing keys are unavailable.')
+    if resp.status_code != 200:
+        raise InvalidTokenError('Signing keys unavailable (%d).'
+                                % resp.status_code)
+    max_age = re.search(r'max-age=(\d+)',
+                        resp.headers.get('Cache-Control', ''))
+    ttl = int(max_age.group(1)) if max_age else CERTS_CACHE_TTL
+    return time.time() + ttl, json.loads(resp.content)['keys']
+
+
+def _get_signing_keys(refresh=False):
+    """Return {key id: RSA key} of Google's signing keys, from the instance
+    cache, memcache or the key server (if refresh, from the key server).
+    """
+    now = time.time()
+    cached = _signing_keys.get('google')
+    if not refresh and cached and cached[0] > now:
+        return cached[1]
+
+    jwks = None if refresh else memcache.get(MEMCACHE_CERTS_KEY)
+    if jwks is None or jwks[0] <= now:
+        jwks = _fetch_signing_keys()
+        memcache.set(MEMCACHE_CERTS_KEY, jwks,
+                     time=max(int(jwks[0] - now), 1))
+
+    keys = dict((jwk['kid'], RSA.construct((_to_int(jwk['n']),
+                                            _to_int(jwk['e']))))
+                for jwk in jwks[1] if jwk.get('kty') == 'RSA')
+    _signing_keys['google'] = (jwks[0], keys)
+    return keys
+
+
+def verify_id_token(token):
+    """Verify a Google ID token locally and return its claims.
+
+    Raises InvalidTokenError if the token is malformed, is not signed by
+    Google, or has the wrong issuer or audience, or has expired.
+    """
+    try:
+        header, payload, signature = str(token).split('.')
+        header_data = json.loads(_b64decode(header))
+        claims = json.loads(_b64decode(payload))
+        signature = _b64decode(signature)
+    except (ValueError, TypeError):
+        raise InvalidTokenError('Not a JWT.')
+    if header_data.get('alg') != 'RS256':
+        raise InvalidTokenError('Unsupported algorithm.')
+
+    kid = header_data.get('kid')
+    key = _get_signing_keys().get(kid)
+    if key is None:
+        # the keys are rotated; the token may use a newer key
+        key = _get_signing_keys(refresh=True).get(kid)
+    if key is None:
+        raise InvalidTokenError('Unknown signing key.')
+    digest = SHA256.new('%s.%s' % (header, payload))
+    if not PKCS1_v1_5.new(key).verify(digest, signature):
+        raise InvalidTokenError('Invalid signature.')
+
+    now = time.time()
+    if claims.get('iss') not in ISSUERS:
+        raise InvalidTokenError('Invalid issuer.')
+    if claims.get('aud') not in AUDIENCES:
+        raise InvalidTokenError('Invalid audience.')
+    if not claims.get('sub'):
+        raise InvalidTokenError('No subject.')
+    exp = claims.get('exp')
+    if not isinstance(exp, (int, long, float)):
+        raise InvalidTokenError('No expiry.')
+    if now >= exp + CLOCK_SKEW:
+        raise InvalidTokenError('Token expired.')
+    return claims
+
+
+def _tokeninfo(token, token_type):
+    """Look the token up with the tokeninfo endpoint. Returns (expiry time,
+    user id); the user id is empty if the token is invalid. Raises
+    ServiceUnavailableException if the endpoint is unreachable.
+    """
+    unreachable = 0
+    for i in range(TOKENINFO_ATTEMPTS):
+        try:
+            resp = urlfetch.fetch(TOKENINFO_URL % (token_type, token))
+        except urlfetch.DownloadError:
+            unreachable += 1
+            continue
+        if resp.status_code == 200:
+            info = json.loads(resp.content)
+            return (time.time() + int(info.get('expires_in', 0)),
+                    info.get('user_id', ''))
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            # not an ID token; look it up as an access token
+            token_type = 'access_token'
+    if unreachable == TOKENINFO_ATTEMPTS:
+        raise ServiceUnavailableException(
+            'Cannot verify tokens now; tokeninfo is unavailable.')
+    return 0, ''
+
+
+def get_user_id(token, token_type):
+    """Return the user id of a bearer token ('id_token' or 'access_token'),
+    or an empty string if the token is invalid.
+    """
+    token_hash = hashlib.sha256(token).hexdigest()
+    now = time.time()
+    cached = _identities.get(token_hash)
+    if cached is None:
+        cached = memcache.get(MEMCACHE_TOKEN_KEY_TPL % token_hash)
+    if cached is not None and cached[0] > now:
+        _identities.put(token_hash, cached)
+        return cached[1]
+
+    identity = None
+    if token_type == 'id_token':
+        try:
+            claims = verify_id_token(token)
+            identity = (claims['exp'], claims['sub'])
+        except InvalidTokenError:
+            # e.g. an access token sent as an ID token
+            token_type = 'access_token'
+    if identity is None:
+        identity = _tokeninfo(token, token_type)
+
+    if identity[1] and identity[0] > now:
+        _identities.put(token_hash, identity)
+        memcache.set(MEMCACHE_TOKEN_KEY_TPL % token_hash, identity,
+                     time=max(int(identity[0] - now), 1))
+    return identity[1]
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""tokens_test.py
+
+Tests of local ID token verification in tokens.py, against a stand-in key
+server serving a locally generated RSA key. Run with the App Engine SDK on
+the path:
+
+    python -m unittest tokens_test
+
+"""
+
+import base64
+import binascii
+import json
+import time
+import unittest
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+from google.appengine.ext import testbed
+
+import tokens
+
+KEY_ID = 'test-key'
+
+
+def _b64encode(data):
+    """Encode a JWT segment: base64url without padding."""
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _int_b64encode(value):
+    """Encode an unsigned integer as a big-endian base64url segment."""
+    hexed = '%x' % value
+    return _b64encode(binascii.unhexlify('0' * (len(hexed) % 2) + hexed))
+
+
+class VerifyIdTokenTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = RSA.generate(2048)
+        cls.other_key = RSA.generate(2048)
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        tokens._signing_keys.clear()
+
+        # stand-in key server, publishing self.key
+        jwks = [{'kty': 'RSA', 'kid': KEY_ID, 'alg': 'RS256',
+                 'n': _int_b64encode(self.key.n),
+                 'e': _int_b64encode(self.key.e)}]
+        self.fetch_signing_keys = tokens._fetch_signing_keys
+        tokens._fetch_signing_keys = lambda: (time.time() + 3600, jwks)
+
+    def tearDown(self):
+        tokens._fetch_signing_keys = self.fetch_signing_keys
+        self.testbed.deactivate()
+
+    def token(self, key=None, **claims):
+        """Return an ID token with claims, signed with key."""
+        payload = {'iss': 'accounts.google.com', 'aud': tokens.AUDIENCES[0],
+                   'sub': '1234', 'exp': int(time.time()) + 600}
+        payload.update(claims)
+        payload = dict((name, value) for name, value in payload.items()
+                       if value is not None)
+        signing_input = '%s.%s' % (
+            _b64encode(json.dumps({'alg': 'RS256', 'kid': KEY_ID})),
+            _b64encode(json.dumps(payload)))
+        signature = PKCS1_v1_5.new(key or self.key).sign(
+            SHA256.new(signing_input))
+        return '%s.%s' % (signing_input, _b64encode(signature))
+
+    def assertInvalid(self, token, message):
+        with self.assertRaises(tokens.InvalidTokenError) as raised:
+            tokens.verify_id_token(token)
+        self.assertEqual(str(raised.exception), message)
+
+    def test_valid(self):
+        self.assertEqual(tokens.verify_id_token(self.token())['sub'], '1234')
+
+    def test_expired_within_clock_skew(self):
+        exp = int(time.time()) - tokens.CLOCK_SKEW + 30
+        self.assertEqual(tokens.verify_id_token(self.token(exp=exp))['exp'],
+                         exp)
+
+    def test_expired(self):
+        exp = int(time.time()) - tokens.CLOCK_SKEW - 1
+        self.assertInvalid(self.token(exp=exp), 'Token expired.')
+
+    def test_no_expiry(self):
+        self.assertInvalid(self.token(exp=None), 'No expiry.')
+
+    def test_wrong_audience(self):
+        self.assertInvalid(self.token(aud='someone-else'),
+                           'Invalid audience.')
+
+    def test_bad_signature(self):
+        self.assertInvalid(self.token(key=self.other_key),
+                           'Invalid signature.')
+
+
+if __name__ == '__main__':
+    unittest.main()
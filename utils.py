@@ -1,15 +1,64 @@
+import base64
+import functools
+import heapq
+import itertools
 import json
+import logging
 import os
-import time
 import uuid
 
+from collections import namedtuple
 from datetime import datetime
 
-from google.appengine.api import urlfetch
+from google.appengine.api.datastore_errors import BadRequestError
+from google.appengine.api.datastore_errors import BadValueError
+from google.appengine.api.datastore_errors import NeedIndexError
+from google.appengine.datastore import datastore_query
 from google.appengine.ext import ndb
 
+from cache import LRUCache
 from models import Profile
 
+import stats
+import tokens
+
+# estimated fraction of entities matched by a filter without statistics
+DEFAULT_SELECTIVITY = {
+    '=':    0.1,
+    '!=':   0.9,
+    '<':    0.33,
+    '<=':   0.33,
+    '>':    0.33,
+    '>=':   0.33
+}
+
+# an underlying query of MultiPropInequality: results are post filtered by
+# post_filters, and skipped if they match any of skip_filters. chosen is the
+# name of the candidate property filtered by the datastore
+_Run = namedtuple('_Run', 'query post_filters skip_filters chosen')
+
+# Python operators of datastore filter operators; ndb turns != into
+# < OR > before filters get here
+_COMPARISONS = {
+    '=':    '==',
+    '<':    '<',
+    '<=':   '<=',
+    '>':    '>',
+    '>=':   '>='
+}
+
+# compiled post filter evaluators, by filter shape
+_compiled_filters = LRUCache(max_size=500, ttl=24 * 3600)
+
+# position of an underlying query that has no more results
+_EXHAUSTED = True
+
+# property types that can be fetched with projection queries
+_PROJECTABLE_TYPES = (ndb.IntegerProperty, ndb.FloatProperty,
+                      ndb.StringProperty, ndb.BooleanProperty,
+                      ndb.DateProperty, ndb.TimeProperty,
+                      ndb.DateTimeProperty, ndb.KeyProperty)
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -21,22 +70,7 @@ def getUserId(user, id_type="email"):
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return tokens.get_user_id(token, token_type)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
@@ -58,8 +92,12 @@ class MultiPropInequality(object):
     using post filters. Only those results that satisfy all of the post filters
     will be handed back.
 
-    For better effeciency, set the first inequality filter that is most likely
-    to return the least number of data.
+    Unless the pre-built query already has an inequality, the property whose
+    inequality filters are estimated to match the fewest entities (from the
+    statistics in stats.py, or from `hints`) is filtered by the datastore and
+    the others become post filters. Without estimates, the first inequality
+    filter added is used. If the query has sort orders, it is sorted by the
+    chosen property first. explain() describes the plan.
 
     To use:
 
@@ -87,19 +125,59 @@ class MultiPropInequality(object):
 
         query.filter(Model.prop1!=0)            # (better) query is updated
 
+    Results can be sorted with order(), on any property. The property with
+    the first sort order is preferred for the datastore inequality, so the
+    datastore returns the results in order; otherwise fetch(limit) keeps the
+    first limit results in a heap while reading.
+
     To access the result set, iterate through:
 
         for result in query:
             # do something with result
+
+    or fetch a limited number of results, or a page at a time:
+
+        results = query.fetch(20)
+        results, cursor, more = query.fetch_page(20)
+        results, cursor, more = query.fetch_page(20, start_cursor=cursor)
+
+    fetch_page() returns a MultiCursor, which can be sent to clients with
+    cursor.urlsafe() and read back with MultiCursor(urlsafe=...).
+
+    With projection_prefilter=True, the underlying query is run as a
+    projection on the properties used by the post filters. Post filters are
+    evaluated on the projected rows, and only the surviving entities are
+    fetched, with get_multi in batches of batch_size. This saves reading
+    large entities that are filtered out. Entities without a value for a
+    projected property are not returned. The full query is used instead if
+    a post filter property cannot be projected (unindexed, repeated or used
+    in an equality filter) or the projection's composite index is missing.
+
+    An OR filter whose branches each have equalities or inequalities on one
+    property is fanned out into one underlying query per branch when that is
+    estimated to read fewer entities. The queries run concurrently; their
+    results are merged in sort order (if all are sorted the same way), and
+    an entity matched by several branches is returned once.
+
+    The number of entities scanned and returned is added to `scanned` and
+    `returned`, and to the per-kind counters of stats.record_scan().
     """
 
-    def __init__(self, model_or_query):
+    def __init__(self, model_or_query, hints=None,
+                 projection_prefilter=False, batch_size=100):
         """Creates new instance of this class.
 
         Parameters:
             model_or_query - Required. An instance of a Model or a pre-built
                              Query object with at most 1 property that is being
                              evaluated for inequalities.
+            hints          - Optional. Dictionary of property name to the
+                             estimated fraction of entities matched by the
+                             inequality filters on that property. Used for
+                             properties without statistics.
+            projection_prefilter - Optional. Evaluate post filters on a
+                             projection query before fetching entities.
+            batch_size     - Optional. Number of entities fetched per batch.
         """
         if isinstance(model_or_query, ndb.model.MetaModel):
             self.query = model_or_query.query()
@@ -111,18 +189,26 @@ class MultiPropInequality(object):
             )
 
         self.first_inequality = self._get_first_inequality(self.query.filters)
+        self.hints = hints or {}
+        self.projection_prefilter = projection_prefilter
+        self.batch_size = batch_size
+        self.inq_candidates = []    # (property name, node)
         self.post_inq_filters = []
+        self.ordered = False
+        self.scanned = 0
+        self.returned = 0
+        self._plan_cache = None
 
 
     def filter(self, *args):
         """Checks if each arg is an inequality filter and appends it to the list
         inequality post filters.
 
-        If arg is an inquality filter (or at least one of its subnodes is an
-        inequality filter), and operates on a property that is different from
-        the first inequality, then it will be added to the list of post
-        inequality filters. Otherwise, it will be passed on to the underlying
-        query.
+        If arg has no inequality filter, it is passed on to the underlying
+        query. If its inequalities all operate on one property, it is a
+        candidate for the datastore-side inequality (or, if the pre-built query
+        has an inequality, passed on when operating on the same property).
+        Otherwise, it will be added to the list of post inequality filters.
 
         Parameters:
             args - Optional. Node. Can be instances of any of the subclasess of
@@ -139,6 +225,23 @@ class MultiPropInequality(object):
             if not self._push_filter(arg):
                 self.query = self.query.filter(arg)
 
+        self._plan_cache = None
+        return self
+
+
+    def order(self, *args):
+        """Sorts the results, like Query.order().
+
+        The datastore has to sort by the inequality property first, so the
+        sort orders of a pre-built query may be changed. Orders added with
+        this method are always followed: if the datastore cannot return the
+        results in order, they are sorted in memory (see fetch()).
+
+        Returns the instance of this class.
+        """
+        self.query = self.query.order(*args)
+        self.ordered = True
+        self._plan_cache = None
         return self
 
 
@@ -154,40 +257,318 @@ class MultiPropInequality(object):
         """Returns a list of inequalities in a given node and all of it's
         subnodes
         """
-        inequalities = []
+        return [filter_dict for filter_dict in self._get_filters(f_node)
+                    if filter_dict['symbol'] != '=']
+
+
+    def _get_filters(self, f_node):
+        """Returns a list of filters (as dictionaries) in a given node and all
+        of it's subnodes
+        """
+        filters = []
         if isinstance(f_node,
                 (ndb.query.DisjunctionNode, ndb.query.ConjunctionNode)):
             for f_n in f_node:
-               inequalities.extend(self._get_inequalities(f_n))
+               filters.extend(self._get_filters(f_n))
         elif isinstance(f_node, ndb.query.FilterNode):
-            filter_dict = self._node_to_dict(f_node)
-            if filter_dict['symbol'] != '=':
-                inequalities.append(filter_dict)
-        return inequalities
+            filters.append(self._node_to_dict(f_node))
+        return filters
 
 
     def _push_filter(self, filter_node):
-        """Adds filter_node to the list post inquality filters if filter_node
-        has at least 1 inquality that operates on a property that is different
-        from the first inequality.
+        """Adds filter_node to the inequality candidates or to the list of post
+        inequality filters if it has at least 1 inequality (other than on the
+        property of the pre-built query's inequality).
 
-        Returns True if filter_node is added to the list of post inquality
-        filters. If filter_node is the first inequality, returns False.
+        Returns False if filter_node should be passed on to the query.
         """
-        inequalities = self._get_inequalities(filter_node)
-        push_to_post = False
-
-        for inq in inequalities:
-            if not self.first_inequality:
-                self.first_inequality = inq
-            elif self.first_inequality['name'] != inq['name']:
-                push_to_post = True
-                break
+        names = set(inq['name'] for inq in self._get_inequalities(filter_node))
 
-        if push_to_post:
+        if not names:
+            return False
+        if self.first_inequality:
+            if names == set([self.first_inequality['name']]):
+                return False
             self.post_inq_filters.append(filter_node)
+        elif len(names) == 1:
+            self.inq_candidates.append((names.pop(), filter_node))
+        else:
+            self.post_inq_filters.append(filter_node)
+        return True
+
 
-        return push_to_post
+    def _plan(self, pinned=None):
+        """Returns (index of the fanned out OR in post_inq_filters or None,
+        list of _Runs): the underlying queries with their post filters,
+        choosing which candidate property is filtered by the datastore, and
+        whether a post filter OR is fanned out.
+
+        pinned is a plan's (index, [chosen property per run]), as stored in a
+        MultiCursor, to plan the same way as when the cursor was made.
+        """
+        if pinned is not None:
+            fan_index, chosen = pinned
+            try:
+                if fan_index is None:
+                    query, post_filters, _, _ = self._apply_candidates(
+                        self.query, forced=chosen[0])
+                    return None, [_Run(query, post_filters, [], chosen[0])]
+                return self._plan_fan_out(None, pinned)
+            except (IndexError, TypeError):
+                raise BadValueError('Cursor does not match the query.')
+
+        if self._plan_cache is None:
+            query, post_filters, chosen, estimate = \
+                self._apply_candidates(self.query)
+            self._plan_cache = self._plan_fan_out(estimate) or \
+                (None, [_Run(query, post_filters, [], chosen)])
+        return self._plan_cache
+
+
+    def _apply_candidates(self, query, forced=None):
+        """Filters query by the inequality candidates on one property; the
+        other candidates become post filters.
+
+        The property is `forced` if given, otherwise the one estimated to
+        match the fewest entities. Returns (query, post filters, chosen
+        property, estimated fraction of entities matched by the candidates
+        added to query).
+        """
+        post_filters = list(self.post_inq_filters)
+        names = []
+        for name, _ in self.inq_candidates:
+            if name not in names:
+                names.append(name)
+        first_order = self._effective_orders(self.query)[0][0] \
+                        if self.ordered else None
+        if forced is None and first_order in names:
+            # the datastore can then return results in the requested order
+            chosen = first_order
+        elif forced is None and names:
+            chosen = min(names, key=lambda name: (
+                self._estimate_property(name), names.index(name)))
+        else:
+            chosen = forced
+
+        for name, node in self.inq_candidates:
+            if name == chosen:
+                query = query.filter(node)
+            else:
+                post_filters.append(node)
+        if chosen in names:
+            return (self._order_first(query, chosen), post_filters, chosen,
+                    self._estimate_property(chosen))
+        if self.first_inequality:
+            query = self._order_first(query, self.first_inequality['name'])
+        return query, post_filters, chosen, 1.0
+
+
+    def _plan_fan_out(self, single_estimate, pinned=None):
+        """Returns (index in post_inq_filters, _Runs) fanning out a post
+        filter OR into one underlying query per branch, or None if no OR is
+        worth fanning out.
+
+        Each branch's query is the underlying query filtered by the branch's
+        equalities and its inequalities on one property. Every query is still
+        post filtered by all post filters, so the results are exact. Results
+        of a branch that also match the pushed filters of an earlier branch
+        are skipped, since the earlier branch returns them.
+
+        The OR is fanned out if the estimated fractions of entities read by
+        the branches add up to less than single_estimate, the fraction read
+        without fanning out, or if the plan is pinned.
+        """
+        indexes = [pinned[0]] if pinned else range(len(self.post_inq_filters))
+        for index in indexes:
+            dis_node = self.post_inq_filters[index]
+            if not isinstance(dis_node, ndb.query.DisjunctionNode):
+                if pinned:
+                    raise BadValueError('Cursor does not match the query.')
+                continue
+
+            runs = []
+            cost = 0.0
+            previous = []
+            for branch in dis_node:
+                nodes, name = self._pushable(branch)
+                if self.first_inequality and \
+                        name not in (None, self.first_inequality['name']):
+                    nodes = [f_n for f_n in nodes
+                                if self._node_to_dict(f_n)['symbol'] == '=']
+                    name = None
+                if not nodes:
+                    break
+
+                query = self.query.filter(*nodes)
+                own_inequality = name and not self.first_inequality
+                if pinned:
+                    forced = pinned[1][len(runs)]
+                else:
+                    forced = name if own_inequality else None
+                query, post_filters, chosen, estimate = \
+                    self._apply_candidates(query, forced=forced)
+                if own_inequality:
+                    query = self._order_first(query, name)
+                cost += estimate * self._estimate_nodes(nodes)
+                runs.append(_Run(query, post_filters, list(previous), chosen))
+                previous.append(
+                    ndb.AND(*nodes) if len(nodes) > 1 else nodes[0])
+            else:
+                if pinned or cost < single_estimate:
+                    return index, runs
+            if pinned:
+                raise BadValueError('Cursor does not match the query.')
+        return None
+
+
+    def _pushable(self, branch):
+        """Returns (FilterNodes, property name) of the filters in an OR branch
+        that an underlying query can run: equalities, and inequalities on
+        the first property with one (its name, or None if none).
+        """
+        if isinstance(branch, ndb.query.FilterNode):
+            children = [branch]
+        elif isinstance(branch, ndb.query.ConjunctionNode):
+            children = list(branch)
+        else:
+            children = []
+
+        nodes = []
+        name = None
+        for f_n in children:
+            if not isinstance(f_n, ndb.query.FilterNode):
+                continue
+            f_dict = self._node_to_dict(f_n)
+            if f_dict['symbol'] == '=':
+                nodes.append(f_n)
+            elif name in (None, f_dict['name']):
+                name = f_dict['name']
+                nodes.append(f_n)
+        return nodes, name
+
+
+    def _estimate_nodes(self, nodes):
+        """Returns the estimated fraction of entities matched by all of the
+        FilterNodes, using default selectivities where there are no
+        statistics.
+        """
+        estimate = 1.0
+        for f_n in nodes:
+            f_dict = self._node_to_dict(f_n)
+            node_estimate = stats.estimate(self.query.kind, f_dict['name'],
+                                           f_dict['symbol'], f_dict['value'])
+            if node_estimate is None:
+                node_estimate = DEFAULT_SELECTIVITY[f_dict['symbol']]
+            estimate *= node_estimate
+        return estimate
+
+
+    def _estimate_property(self, name):
+        """Returns the estimated fraction of entities matched by the candidate
+        filters on a property. 1.0 if unknown.
+        """
+        estimate = 1.0
+        for c_name, node in self.inq_candidates:
+            if c_name == name:
+                node_estimate = self._estimate_node(node)
+                if node_estimate is None:
+                    return self.hints.get(name, 1.0)
+                estimate *= node_estimate
+        return estimate
+
+
+    def _estimate_node(self, a_node):
+        """Returns the estimated fraction of entities matched by a Node, or
+        None if there are no statistics for one of its properties.
+        """
+        if isinstance(a_node, ndb.query.FilterNode):
+            f_dict = self._node_to_dict(a_node)
+            return stats.estimate(self.query.kind, f_dict['name'],
+                                  f_dict['symbol'], f_dict['value'])
+        estimates = [self._estimate_node(f_n) for f_n in a_node]
+        if None in estimates:
+            return None
+        if isinstance(a_node, ndb.query.DisjunctionNode):
+            return min(sum(estimates), 1.0)
+        estimate = 1.0
+        for node_estimate in estimates:
+            estimate *= node_estimate
+        return estimate
+
+
+    def _order_first(self, query, name):
+        """Returns query sorted by property `name` first, as the datastore
+        requires for an inequality on it. Queries without sort orders are
+        returned as is.
+        """
+        if query.orders is None:
+            return query
+        if isinstance(query.orders, datastore_query.CompositeOrder):
+            orders = list(query.orders.orders)
+        else:
+            orders = [query.orders]
+        if orders[0].prop == name:
+            return query
+
+        unordered = ndb.Query(kind=query.kind, ancestor=query.ancestor,
+                              filters=query.filters, app=query.app,
+                              namespace=query.namespace,
+                              default_options=query.default_options,
+                              projection=query.projection,
+                              group_by=query.group_by)
+        return unordered.order(ndb.GenericProperty(name),
+                               *[o for o in orders if o.prop != name])
+
+
+    def _key_ordered(self, query):
+        """Returns query sorted by key last. Queries with != or IN filters are
+        run as several datastore queries, which only produce cursors when
+        sorted by key; unsorted ones are sorted by their inequality property
+        first, as the datastore requires.
+        """
+        orders = self._effective_orders(query)
+        if orders and orders[-1][0] == '__key__':
+            return query
+        key_order = datastore_query.PropertyOrder('__key__')
+        if query.orders is not None:
+            return query.order(key_order)
+        inequalities = self._get_inequalities(query.filters)
+        if inequalities:
+            return query.order(ndb.GenericProperty(inequalities[0]['name']),
+                               key_order)
+        return query.order(key_order)
+
+
+    def _effective_orders(self, query):
+        """Returns the [(property name, direction)] that results of query are
+        sorted by (before the key), or None if unknown.
+        """
+        if query.orders is not None:
+            if isinstance(query.orders, datastore_query.CompositeOrder):
+                orders = query.orders.orders
+            else:
+                orders = [query.orders]
+            return [(order.prop, order.direction) for order in orders]
+        if isinstance(query.filters, ndb.query.DisjunctionNode):
+            return None
+        inequalities = self._get_inequalities(query.filters)
+        if inequalities:
+            return [(inequalities[0]['name'],
+                     datastore_query.PropertyOrder.ASCENDING)]
+        return []
+
+
+    def explain(self):
+        """Returns a description of how the query is run."""
+        described = ['datastore: %r; post filters: %s' % (
+                        run.query,
+                        ' AND '.join(repr(f_n) for f_n in run.post_filters)
+                            or 'none')
+                     for run in self._plan()[1]]
+        if len(described) == 1:
+            return described[0]
+        return 'fan-out of %d queries: %s' % (
+            len(described), ' | '.join(described))
 
 
     def _node_to_dict(self, f_node):
@@ -204,93 +585,422 @@ class MultiPropInequality(object):
         return filter_dict
 
 
-    def _make_evaluator(self, filter_node):
-        """Returns an evaluator for a given FilterNode"""
-        def make_closure(f_d):
-            if (f_d['symbol'] == '>'):
-                return lambda x: getattr(x, f_d['name']) > f_d['value']
-            elif (f_d['symbol'] == '<'):
-                return lambda x: getattr(x, f_d['name']) < f_d['value']
-            elif (f_d['symbol'] == '>='):
-                return lambda x: getattr(x, f_d['name']) >= f_d['value']
-            elif (f_d['symbol'] == '<='):
-                return lambda x: getattr(x, f_d['name']) <= f_d['value']
-            elif (f_d['symbol'] == '!='):
-                return lambda x: getattr(x, f_d['name']) != f_d['value']
-            elif (f_d['symbol'] == '='):
-                return lambda x: getattr(x, f_d['name']) == f_d['value']
-            else:
-                raise NotImplementedError(
-                    'Unsuported operator: {}'.format(f_d['symbol'])
-                )
+    def _filter_shape(self, node, values):
+        """Returns the shape of a filter tree: its structure with property
+        names and operators, but not the values, which are appended to values
+        (converted to the property type). None if the node is ignored.
+        """
+        if isinstance(node, ndb.query.FilterNode):
+            f_dict = self._node_to_dict(node)
+            prop = ndb.Model._kind_map[self.query.kind] \
+                            ._properties[f_dict['name']]
+            value = f_dict['value']
+            # FilterNode coverts TimeProperty and DateProperty to datetime.
+            # Convert back to time or date
+            if isinstance(value, datetime):
+                if isinstance(prop, ndb.TimeProperty):
+                    value = value.time()
+                elif isinstance(prop, ndb.DateProperty):
+                    value = value.date()
+            values.append(value)
+            return ('filter', f_dict['name'], f_dict['symbol'], prop._repeated)
+
+        if isinstance(node, ndb.query.ConjunctionNode):
+            operator = 'and'
+        elif isinstance(node, ndb.query.DisjunctionNode):
+            operator = 'or'
+        else:
+            # FalseNode is ignored
+            # ParameterNode is not yet supported
+            return None
+        shapes = [self._filter_shape(f_n, values) for f_n in node]
+        return (operator,) + tuple(shape for shape in shapes
+                                        if shape is not None)
 
-        f_dict = self._node_to_dict(filter_node)
 
-        # FilterNode coverts TimeProperty and DateProperty to datetime.
-        # Convert back to time or date
-        prop_type = ndb.Model._kind_map[self.query.kind] \
-                        ._properties[f_dict['name']].__class__.__name__
-        if prop_type == 'TimeProperty' \
-                and isinstance(f_dict['value'], datetime):
-            f_dict['value'] = f_dict['value'].time()
-        elif prop_type == 'DateProperty' \
-                and isinstance(f_dict['value'], datetime):
-            f_dict['value'] = f_dict['value'].date()
+    def _make_evaluator(self, nodes, excluded=()):
+        """Returns an evaluator that is True for entities that satisfy all of
+        nodes and none of excluded.
 
-        return make_closure(f_dict)
+        The evaluator is compiled once per filter shape; repeat queries with
+        other values reuse it.
+        """
+        values = []
+        shapes = [self._filter_shape(f_n, values) for f_n in nodes]
+        if excluded:
+            shapes.append(('not', ('or',) + tuple(
+                self._filter_shape(f_n, values) for f_n in excluded)))
+        shape = ('and',) + tuple(shape for shape in shapes if shape is not None)
+
+        program = _compiled_filters.get(shape)
+        if program is None:
+            program = _compile_filters(shape)
+            _compiled_filters.put(shape, program)
+        return functools.partial(program, v=tuple(values))
+
+
+    def _projection(self, query, post_filters):
+        """Returns the sorted names of the properties used by post_filters if
+        query can be run as a projection on them, otherwise None.
+        """
+        if query.projection or not post_filters:
+            return None
+        names = set()
+        for f_n in post_filters:
+            names.update(f_d['name'] for f_d in self._get_filters(f_n))
+        equalities = set(f_d['name'] for f_d in self._get_filters(query.filters)
+                            if f_d['symbol'] == '=')
+
+        properties = ndb.Model._kind_map[query.kind]._properties
+        for name in names:
+            prop = properties.get(name)
+            if not isinstance(prop, _PROJECTABLE_TYPES) or prop._repeated \
+                    or not prop._indexed or name in equalities:
+                return None
+        return sorted(names)
+
+
+    def _make_run_evaluators(self, run):
+        """Returns (prefilter, accept) evaluators of a _Run. prefilter checks
+        the post filters (on projected rows too); accept also skips entities
+        returned by an earlier fanned out branch.
+        """
+        prefilter = self._make_evaluator(run.post_filters)
+        if not run.skip_filters:
+            return prefilter, prefilter
+        return prefilter, self._make_evaluator(run.post_filters,
+                                               excluded=run.skip_filters)
+
+
+    def _start(self, index, run, position, produce_cursors, counts,
+               exhausted):
+        """Starts the underlying query of a _Run from position (None, or a
+        websafe cursor) and returns a generator of (run index, accepted
+        entity, cursor after it or None). The datastore fetches
+        asynchronously.
+        """
+        if position is _EXHAUSTED:
+            return iter(())
+        if produce_cursors:
+            run = run._replace(query=self._key_ordered(run.query))
+
+        options = {'batch_size': self.batch_size,
+                   'produce_cursors': produce_cursors}
+        if position is not None:
+            options['start_cursor'] = datastore_query.Cursor(urlsafe=position)
+        projection = self._projection(run.query, run.post_filters) \
+                        if self.projection_prefilter else None
+        if projection:
+            rows = run.query.iter(projection=projection, **options)
+        else:
+            rows = run.query.iter(**options)
+        return self._iter_run(index, run, rows, projection, options, counts,
+                              exhausted)
 
 
-    def _make_and_evaluator(self, con_node):
-        """Returns an evaluator that performs AND operation on subnodes of a
-        given ConjunctionNode
+    def _iter_run(self, index, run, rows, projection, options, counts,
+                  exhausted):
+        """Yields (run index, accepted entity, cursor after it) from the rows
+        of a _Run's query, adding the run index to exhausted at the end.
         """
-        post_evals = self._check_node(con_node)
-        def and_evaluators(x):
-            for p_eval in post_evals:
-                if not p_eval(x):
-                    return False
-            return True
+        def cursor_after():
+            if options['produce_cursors']:
+                return rows.cursor_after()
+            return None
 
-        return and_evaluators
+        prefilter, accept = self._make_run_evaluators(run)
+        if projection:
+            try:
+                rows.has_next()
+            except (NeedIndexError, BadRequestError) as e:
+                logging.warning('Projection prefilter not possible (%s), '
+                                'running full query: %r', e, run.query)
+                projection = None
+                rows = run.query.iter(**options)
+
+        if not projection:
+            for result in rows:
+                counts[0] += 1
+                if accept(result):
+                    counts[1] += 1
+                    yield index, result, cursor_after()
+            exhausted.add(index)
+            return
+
+        keys = []       # (key, cursor after its row)
+        for row in rows:
+            counts[0] += 1
+            if prefilter(row):
+                keys.append((row.key, cursor_after()))
+            if len(keys) >= self.batch_size:
+                for result in self._get_survivors(index, keys, accept, counts):
+                    yield result
+                keys = []
+        for result in self._get_survivors(index, keys, accept, counts):
+            yield result
+        exhausted.add(index)
 
 
-    def _make_or_evaluator(self, dis_node):
-        """Returns an evaluator that performs OR operation on subnodes of a
-        given DisjunctionNode
+    def _get_survivors(self, index, keys, accept, counts):
+        """Fetches entities by (key, cursor) pairs and yields (run index,
+        entity, cursor) for those (still) accepted; they may have changed
+        since the projection was read.
         """
-        post_evals = self._check_node(dis_node)
-        def or_evaluators(x):
-            for p_eval in post_evals:
-                if p_eval(x):
-                    return True
-            return False
+        entities = ndb.get_multi([key for key, _ in keys])
+        for entity, (_, cursor) in zip(entities, keys):
+            if entity is not None and accept(entity):
+                counts[1] += 1
+                yield index, entity, cursor
+
 
-        return or_evaluators
+    def _merge(self, runs, streams):
+        """Merges the results of fanned out runs. If all runs are sorted
+        the same way, the results are merged in that order; otherwise they
+        are returned run by run.
+        """
+        orders = [self._effective_orders(run.query) for run in runs]
+        if None in orders or any(o != orders[0] for o in orders):
+            return itertools.chain(*streams)
 
+        sort_key = _make_sort_key(orders[0])
+        def decorate(stream):
+            for result in stream:
+                yield sort_key(result[1]), result
+
+        return (result for _, result in heapq.merge(
+            *[decorate(stream) for stream in streams]))
+
+
+    def _results(self, runs, positions=None, exhausted=None,
+                 produce_cursors=False):
+        """Yields (run index, entity, cursor) of the results of runs, starting
+        each run from its position in positions. Runs that have no more
+        results are added to exhausted. cursor is None unless
+        produce_cursors.
+
+        Fanned out queries are all started before the results are read, so
+        the datastore runs them concurrently.
+        """
+        positions = positions or [None] * len(runs)
+        exhausted = set() if exhausted is None else exhausted
+        counts = [0, 0]     # scanned, returned
+        try:
+            streams = [self._start(i, run, positions[i], produce_cursors,
+                                   counts, exhausted)
+                        for i, run in enumerate(runs)]
+            results = streams[0] if len(streams) == 1 \
+                        else self._merge(runs, streams)
+            for result in results:
+                yield result
+        finally:
+            self.scanned += counts[0]
+            self.returned += counts[1]
+            if counts[0]:
+                stats.record_scan(self.query.kind, counts[0], counts[1])
+
+
+    def _in_memory_orders(self, runs):
+        """Returns the [(property name, direction)] that results of runs must
+        be sorted by in memory, or None if the datastore returns them in the
+        order requested with order().
+        """
+        if not self.ordered:
+            return None
+        requested = self._effective_orders(self.query)
+        for run in runs:
+            if self._effective_orders(run.query) != requested:
+                return requested
+        return None
 
-    def _check_node(self, a_node):
-        """Returns a list of evaluator functions from a given Node"""
-        output = []
-        for f_n in a_node:
-            if isinstance(f_n, ndb.query.ConjunctionNode):
-                output.append(self._make_and_evaluator(f_n))
-            elif isinstance(f_n, ndb.query.DisjunctionNode):
-                output.append(self._make_or_evaluator(f_n))
-            elif isinstance(f_n, ndb.query.FilterNode):
-                output.append(self._make_evaluator(f_n))
-            # FalseNode is ignored
-            # ParameterNode is not yet supported
-        return output
+
+    def fetch(self, limit=None):
+        """Returns a list of up to limit results (all if limit is None).
+
+        Results sorted in memory are selected with a heap of limit entities
+        while reading the underlying queries, so memory stays bounded by
+        limit rather than the number of matching entities.
+        """
+        _, runs = self._plan()
+        orders = self._in_memory_orders(runs)
+        if orders is None or limit is None:
+            return list(itertools.islice(self, limit))
+        return heapq.nsmallest(
+            limit, (result for _, result, _ in self._results(runs)),
+            key=_make_sort_key(orders))
+
+
+    def fetch_page(self, page_size, start_cursor=None):
+        """Returns (results, cursor, more), like ndb.Query.fetch_page(): up to
+        page_size results following start_cursor, a MultiCursor to fetch the
+        next page from, and whether there are probably more results.
+
+        The underlying queries are read only until the page is full. They are
+        sorted by key last, so that those run as several datastore queries
+        (with != or IN filters) produce cursors.
+        """
+        if start_cursor is None:
+            fan_index, runs = self._plan()
+            positions = [None] * len(runs)
+        else:
+            fan_index, runs = self._plan(pinned=start_cursor.plan)
+            positions = list(start_cursor.positions)
+            if len(positions) != len(runs):
+                raise BadValueError('Cursor does not match the query.')
+        if self._in_memory_orders(runs) is not None:
+            raise BadRequestError(
+                'Results sorted in memory cannot be paged; sort by the '
+                'inequality property filtered by the datastore or use fetch().')
+
+        exhausted = set(i for i, position in enumerate(positions)
+                            if position is _EXHAUSTED)
+        results = []
+        if page_size > 0:
+            page = self._results(runs, positions, exhausted,
+                                 produce_cursors=True)
+            try:
+                for index, entity, cursor in page:
+                    results.append(entity)
+                    positions[index] = cursor.urlsafe()
+                    if len(results) >= page_size:
+                        break
+            finally:
+                page.close()
+        for index in exhausted:
+            positions[index] = _EXHAUSTED
+
+        cursor = MultiCursor(plan=(fan_index, [run.chosen for run in runs]),
+                             positions=positions)
+        return results, cursor, len(exhausted) < len(runs)
 
 
     def __iter__(self):
         """Iterates through the result set of the underlying query, and hands
         back only those that satify all of the post inequality filters.
         """
-        post_evaluator = self._make_and_evaluator(self.post_inq_filters)
-        for result in self.query:
+        _, runs = self._plan()
+        results = (result for _, result, _ in self._results(runs))
+        orders = self._in_memory_orders(runs)
+        if orders is not None:
+            results = sorted(results, key=_make_sort_key(orders))
+        for result in results:
+            yield result
+
+
+def _compile_filters(shape):
+    """Compiles a filter shape (see MultiPropInequality._filter_shape) into a
+    function evaluate(entity, v), where v are the filter values in order.
+
+    The function is generated as Python source with the operators inline and
+    each property read once, so no closures are called per filter. None
+    only satisfies '=' None; range filters, including the '<' OR '>' that
+    ndb makes of '!=', never match it, as in the datastore. Filters on
+    repeated properties match if any value does.
+    """
+    properties = {}     # property name: local variable
+    values = itertools.count()
+
+    def expression(shape):
+        if shape[0] == 'filter':
+            _, name, symbol, repeated = shape
+            if symbol not in _COMPARISONS:
+                raise NotImplementedError(
+                    'Unsuported operator: {}'.format(symbol))
+            local = properties.setdefault(name, 'p%d' % len(properties))
+            operand = 'e' if repeated else local
+            test = '%s %s v[%d]' % (operand, _COMPARISONS[symbol], next(values))
+            if symbol != '=':
+                test = '%s is not None and %s' % (operand, test)
+            if repeated:
+                return 'any(%s for e in %s)' % (test, local)
+            return '(%s)' % test
+        if shape[0] == 'not':
+            return '(not %s)' % expression(shape[1])
+        if len(shape) == 1:
+            return 'True' if shape[0] == 'and' else 'False'
+        return '(%s)' % (' %s ' % shape[0]).join(
+            expression(child) for child in shape[1:])
+
+    body = expression(shape)
+    source = 'def evaluate(x, v):\n%s    return %s\n' % (
+        ''.join('    %s = getattr(x, %r)\n' % (local, name)
+                    for name, local in sorted(properties.items())),
+        body)
+    namespace = {}
+    exec(compile(source, '<filter %r>' % (shape,), 'exec'), namespace)
+    return namespace['evaluate']
+
+
+def _make_sort_key(orders):
+    """Returns a function giving the sort key of an entity for
+    [(property name, direction)] orders, followed by the entity key.
+    """
+    descending = [direction == datastore_query.PropertyOrder.DESCENDING
+                    for _, direction in orders] + [False]
+    names = [name for name, _ in orders]
+
+    def sort_key(entity):
+        return _SortKey([getattr(entity, name) for name in names] +
+                        [entity.key.flat()], descending)
+
+    return sort_key
+
+
+class _SortKey(object):
+    """Sort key comparing values as the datastore orders them: None first,
+    then ascending or descending per value.
+    """
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def _compare(self, other):
+        for a, b, desc in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            if a is None:
+                result = -1
+            elif b is None:
+                result = 1
+            else:
+                result = -1 if a < b else 1
+            return -result if desc else result
+        return 0
+
+    def __lt__(self, other):
+        return self._compare(other) < 0
+
+    def __eq__(self, other):
+        return self._compare(other) == 0
+
+    def __ne__(self, other):
+        return self._compare(other) != 0
+
+
+class MultiCursor(object):
+    """Position in the results of a MultiPropInequality, returned by
+    fetch_page(). Like datastore_query.Cursor, it is made from its websafe
+    string with MultiCursor(urlsafe=...) and encoded with urlsafe().
+
+    It holds the plan the results were fetched with, so later pages are
+    fetched the same way even if the statistics change, and the cursor of
+    each underlying query.
+    """
+
+    def __init__(self, plan=None, positions=None, urlsafe=None):
+        if urlsafe is not None:
             try:
-                if post_evaluator(result):
-                    yield result
-            except TypeError:
-                pass            # Value of a property from datastore is None
+                data = json.loads(base64.urlsafe_b64decode(str(urlsafe)))
+                plan = (data['plan'][0], list(data['plan'][1]))
+                positions = list(data['positions'])
+            except (TypeError, ValueError, KeyError, IndexError):
+                raise BadValueError('Invalid cursor %r.' % urlsafe)
+        self.plan = plan
+        self.positions = positions
+
+
+    def urlsafe(self):
+        """Returns the cursor as a websafe string."""
+        return base64.urlsafe_b64encode(json.dumps(
+            {'plan': list(self.plan), 'positions': self.positions}))